@@ -18,21 +18,45 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-"""Reference implementation for Bech32 and segwit addresses."""
+"""Reference implementation for Bech32 and segwit addresses.
+
+Tuned for decoding large numbers of strings: the checksum is computed
+with a lookup table instead of a per-bit loop, the HRP expansion is
+folded into the checksum state (and cached) instead of being built as a
+list, and `bech32_verify_many` checks a whole batch at once, vectorized
+with NumPy if it is installed.
+"""
+from functools import lru_cache
+
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+CHARSET_REV = {c: i for i, c in enumerate(CHARSET)}
+
+GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
 
+# XOR of the generator values selected by each possible top 5 bits of the
+# checksum state, so that each symbol costs a single lookup.
+POLYMOD_TABLE = [0] * 32
+for _top in range(32):
+    for _i in range(5):
+        if (_top >> _i) & 1:
+            POLYMOD_TABLE[_top] ^= GENERATOR[_i]
 
-def bech32_polymod(values):
+PRINTABLE = re.compile('[\x21-\x7e]*')
+
+
+def bech32_polymod(values, chk=1):
     """Internal function that computes the Bech32 checksum."""
-    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
-    chk = 1
+    table = POLYMOD_TABLE
     for value in values:
-        top = chk >> 25
-        chk = (chk & 0x1ffffff) << 5 ^ value
-        for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+        chk = (chk & 0x1ffffff) << 5 ^ value ^ table[chk >> 25]
     return chk
 
 
@@ -41,15 +65,20 @@ def bech32_hrp_expand(hrp):
     return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
 
 
+@lru_cache(maxsize=64)
+def bech32_hrp_polymod(hrp):
+    """Checksum state after processing the expanded HRP."""
+    return bech32_polymod(bech32_hrp_expand(hrp))
+
+
 def bech32_verify_checksum(hrp, data):
     """Verify a checksum given HRP and converted data characters."""
-    return bech32_polymod(bech32_hrp_expand(hrp) + data) == 1
+    return bech32_polymod(data, bech32_hrp_polymod(hrp)) == 1
 
 
 def bech32_create_checksum(hrp, data):
     """Compute the checksum values given HRP and data."""
-    values = bech32_hrp_expand(hrp) + data
-    polymod = bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
+    polymod = bech32_polymod([0, 0, 0, 0, 0, 0], bech32_polymod(data, bech32_hrp_polymod(hrp))) ^ 1
     return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
 
 
@@ -59,45 +88,89 @@ def bech32_encode(hrp, data):
     return hrp + '1' + ''.join([CHARSET[d] for d in combined])
 
 
-def bech32_decode(bech):
-    """Validate a Bech32 string, and determine HRP and data."""
-    if ((any(ord(x) < 33 or ord(x) > 126 for x in bech)) or
+def bech32_split(bech):
+    """Split a Bech32 string into HRP and data values, checksum included.
+
+    Returns (None, None) if the string is malformed, without verifying
+    the checksum.
+    """
+    if (not PRINTABLE.fullmatch(bech) or
             (bech.lower() != bech and bech.upper() != bech)):
         return (None, None)
     bech = bech.lower()
     pos = bech.rfind('1')
     if pos < 1 or pos + 7 > len(bech): #or len(bech) > 90:
         return (None, None)
-    if not all(x in CHARSET for x in bech[pos+1:]):
+    try:
+        data = [CHARSET_REV[x] for x in bech[pos+1:]]
+    except KeyError:
         return (None, None)
-    hrp = bech[:pos]
-    data = [CHARSET.find(x) for x in bech[pos+1:]]
-    if not bech32_verify_checksum(hrp, data):
+    return (bech[:pos], data)
+
+
+def bech32_decode(bech):
+    """Validate a Bech32 string, and determine HRP and data."""
+    hrp, data = bech32_split(bech)
+    if hrp is None or not bech32_verify_checksum(hrp, data):
         return (None, None)
     return (hrp, data[:-6])
 
 
+def bech32_verify_many(bechs):
+    """Validate the checksums of many Bech32 strings.
+
+    Returns a list of booleans in the order of `bechs`. With NumPy the
+    checksums of all strings are computed in lockstep, one symbol
+    position at a time.
+    """
+    splits = [bech32_split(b) for b in bechs]
+    if numpy is None:
+        return [hrp is not None and bech32_verify_checksum(hrp, data)
+                for hrp, data in splits]
+
+    valid = [hrp is not None for hrp, _ in splits]
+    lengths = numpy.array([len(data) if hrp else 0 for hrp, data in splits])
+    values = numpy.zeros((len(splits), max(lengths, default=0)), dtype=numpy.uint32)
+    for i, (hrp, data) in enumerate(splits):
+        if hrp is not None:
+            values[i, :len(data)] = data
+    chk = numpy.array([bech32_hrp_polymod(hrp) if hrp else 1 for hrp, _ in splits],
+                      dtype=numpy.uint32)
+
+    table = numpy.array(POLYMOD_TABLE, dtype=numpy.uint32)
+    for col in range(values.shape[1]):
+        step = ((chk & 0x1ffffff) << 5) ^ values[:, col] ^ table[chk >> 25]
+        chk = numpy.where(lengths > col, step, chk)
+    return [v and c == 1 for v, c in zip(valid, chk.tolist())]
+
+
 def convertbits(data, frombits, tobits, pad=True):
-    """General power-of-2 base conversion."""
-    acc = 0
-    bits = 0
-    ret = []
-    maxv = (1 << tobits) - 1
-    max_acc = (1 << (frombits + tobits - 1)) - 1
-    for value in data:
-        if value < 0 or (value >> frombits):
-            return None
-        acc = ((acc << frombits) | value) & max_acc
-        bits += frombits
-        while bits >= tobits:
-            bits -= tobits
-            ret.append((acc >> bits) & maxv)
-    if pad:
-        if bits:
-            ret.append((acc << (tobits - bits)) & maxv)
-    elif bits >= frombits or ((acc << (tobits - bits)) & maxv):
+    """General power-of-2 base conversion.
+
+    `data` may be a list of values or, for `frombits=8`, bytes.
+    """
+    if len(data) and (min(data) < 0 or max(data) >> frombits):
         return None
-    return ret
+    if frombits == 8:
+        acc = int.from_bytes(bytes(data), 'big')
+    else:
+        acc = 0
+        for value in data:
+            acc = (acc << frombits) | value
+
+    count, bits = divmod(len(data) * frombits, tobits)
+    if bits and pad:
+        acc <<= tobits - bits
+        count += 1
+    elif bits:
+        if bits >= frombits or acc & ((1 << bits) - 1):
+            return None
+        acc >>= bits
+
+    if tobits == 8:
+        return list(acc.to_bytes(count, 'big'))
+    maxv = (1 << tobits) - 1
+    return [(acc >> (tobits * i)) & maxv for i in range(count - 1, -1, -1)]
 
 
 def decode(hrp, addr):
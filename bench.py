@@ -0,0 +1,135 @@
+""" Micro-benchmarks for the BOLT11 codec
+
+    python bench.py decode -n 1000
+    python bench.py encode -n 1000
+    python bench.py bech32 -n 1000
+    python bench.py scan -n 1000
+    python bench.py many -n 10000 -w 4
+    python bench.py corpus
+
+The benchmarks against the stored corpus are in bench_codec.py.
+"""
+from bech32 import bech32_decode, bech32_verify_many
+from corpus import PRIVKEY, make_synthetic, save_corpus
+from decimal import Decimal
+from lnaddr import LnAddr, lnencode, lnencode_bitstring, lndecode, lndecode_bitstring, lndecode_many
+
+import click
+import random
+import time
+
+
+def make_addrs(num, seed=0):
+    """A reproducible mix of invoices with and without amount, route hints,
+    expiry and description hashes.
+    """
+    rnd = random.Random(seed)
+    addrs = []
+    for i in range(num):
+        tags = [('d', 'invoice{}'.format(i))] if i % 4 else [('h', 'long description ' * 20)]
+        if i % 3 == 0:
+            tags.append(('x', rnd.randint(60, 86400)))
+        for _ in range(i % 3):
+            tags.append(('r', (
+                bytes([2]) + bytes(rnd.getrandbits(8) for _ in range(32)),
+                bytes(rnd.getrandbits(8) for _ in range(8)),
+                rnd.randint(0, 10**6),
+                rnd.randint(6, 144),
+            )))
+        addr = LnAddr(
+            paymenthash=bytes(rnd.getrandbits(8) for _ in range(32)),
+            amount=Decimal(rnd.randint(1, 10**8)) / 10**11 if i % 5 else None,
+            currency='bcrt',
+            tags=tags,
+        )
+        addrs.append(addr)
+    return addrs
+
+
+def make_invoices(num, seed=0):
+    return [lnencode(a, PRIVKEY) for a in make_addrs(num, seed)]
+
+
+def rate(f, items):
+    """Calls per second of `f` over all `items`.
+    """
+    start_time = time.time()
+    for i in items:
+        f(i)
+    return len(items) / (time.time() - start_time)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@click.command()
+@click.option('-n', '--num', default=1000, help="Number of invoices to decode")
+def decode(num):
+    invoices = make_invoices(num)
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'lndecode_bitstring', rate(lndecode_bitstring, invoices)))
+    # lndecode is lazy, ask for the pubkey to get a full decode
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'lndecode', rate(lambda i: lndecode(i).pubkey, invoices)))
+
+
+@click.command()
+@click.option('-n', '--num', default=1000, help="Number of invoices to encode")
+def encode(num):
+    addrs = make_addrs(num)
+    for f in [lnencode_bitstring, lnencode]:
+        print("{:<20} {:>10.0f} invoices/s".format(
+            f.__name__, rate(lambda a: f(a, PRIVKEY), addrs)))
+
+
+@click.command('bech32')
+@click.option('-n', '--num', default=1000, help="Number of invoices to check")
+def bech32_(num):
+    invoices = make_invoices(num)
+    print("{:<20} {:>10.0f} invoices/s".format('bech32_decode', rate(bech32_decode, invoices)))
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'bech32_verify_many', rate(bech32_verify_many, [invoices]) * len(invoices)))
+
+
+@click.command()
+@click.option('-n', '--num', default=1000, help="Number of invoices to scan")
+def scan(num):
+    invoices = make_invoices(num)
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'full decode', rate(lambda i: lndecode(i).pubkey, invoices)))
+
+    def hash_and_amount(i):
+        addr = lndecode(i)
+        return addr.paymenthash, addr.amount
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'paymenthash, amount', rate(hash_and_amount, invoices)))
+
+
+@click.command()
+@click.option('-n', '--num', default=10000, help="Number of invoices to decode")
+@click.option('-w', '--workers', default=None, type=int, help="Worker processes (default: one per core)")
+def many(num, workers):
+    invoices = make_invoices(num)
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'lndecode', rate(lambda i: lndecode(i).pubkey, invoices)))
+    print("{:<20} {:>10.0f} invoices/s".format(
+        'lndecode_many', rate(lambda i: lndecode_many(i, workers=workers), [invoices]) * num))
+
+
+@click.command()
+@click.option('-n', '--num', default=50, help="Number of invoices of each kind")
+def corpus(num):
+    total = save_corpus('synthetic', make_synthetic(num))
+    print("{} synthetic invoices in corpus".format(total))
+
+
+if __name__ == '__main__':
+    cli.add_command(decode)
+    cli.add_command(encode)
+    cli.add_command(bech32_)
+    cli.add_command(many)
+    cli.add_command(scan)
+    cli.add_command(corpus)
+    cli()
@@ -0,0 +1,74 @@
+""" Round-trip checks and benchmarks of the BOLT11 codec over the corpus
+
+    py.test bench_codec.py
+
+Needs pytest-benchmark. Every invoice in corpus/ must decode to the same
+fields as the reference decoder, and the synthetic ones, which we signed
+ourselves, must re-encode to the exact same string. The benchmarks run
+per source and kind of invoice, see corpus.py.
+"""
+from bech32 import bech32_decode
+from corpus import PRIVKEY, decoded_fields, load_corpus
+from lnaddr import lndecode, lndecode_bitstring, lndecode_cached, lndecode_many, lnencode
+
+import pytest
+
+
+CORPUS = load_corpus()
+SYNTHETIC = [e for e in CORPUS if e['source'] == 'synthetic']
+GROUPS = sorted(set((e['source'], e['kind']) for e in CORPUS))
+
+
+def group_invoices(group):
+    return [e['bolt11'] for e in CORPUS if (e['source'], e['kind']) == group]
+
+
+def groupid(group):
+    return "-".join(group)
+
+
+def hash_and_amount(invoice):
+    addr = lndecode(invoice)
+    return addr.paymenthash, addr.amount
+
+
+@pytest.mark.parametrize("entry", CORPUS, ids=lambda e: e['bolt11'][:24])
+def test_decode_reference(entry):
+    expected = decoded_fields(lndecode_bitstring(entry['bolt11']))
+    assert decoded_fields(lndecode(entry['bolt11'])) == expected
+    assert decoded_fields(lndecode_cached(entry['bolt11'])) == expected
+
+
+@pytest.mark.parametrize("entry", SYNTHETIC, ids=lambda e: e['bolt11'][:24])
+def test_reencode(entry):
+    assert lnencode(lndecode(entry['bolt11']), PRIVKEY) == entry['bolt11']
+
+
+def test_decode_many():
+    invoices = [e['bolt11'] for e in CORPUS]
+    decoded = lndecode_many(invoices, workers=2, chunksize=16)
+    assert [decoded_fields(a) for a in decoded] == [decoded_fields(lndecode(i)) for i in invoices]
+
+
+@pytest.mark.parametrize("group", GROUPS, ids=groupid)
+def test_bench_decode(benchmark, group):
+    invoices = group_invoices(group)
+    benchmark(lambda: [lndecode(i).pubkey for i in invoices])
+
+
+@pytest.mark.parametrize("group", GROUPS, ids=groupid)
+def test_bench_scan(benchmark, group):
+    invoices = group_invoices(group)
+    benchmark(lambda: [hash_and_amount(i) for i in invoices])
+
+
+@pytest.mark.parametrize("group", GROUPS, ids=groupid)
+def test_bench_bech32(benchmark, group):
+    invoices = group_invoices(group)
+    benchmark(lambda: [bech32_decode(i) for i in invoices])
+
+
+@pytest.mark.parametrize("group", [g for g in GROUPS if g[0] == 'synthetic'], ids=groupid)
+def test_bench_encode(benchmark, group):
+    addrs = [lndecode(i) for i in group_invoices(group)]
+    benchmark(lambda: [lnencode(a, PRIVKEY) for a in addrs])
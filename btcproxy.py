@@ -13,6 +13,7 @@ import json
 import logging
 import os
 import threading
+import tracing
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -33,6 +34,10 @@ class ProxiedBitcoinD(BitcoinD):
         self.mocks = {}
 
     def _handle_request(self, r):
+        with tracing.span(r['method'], 'bitcoind'):
+            return self._forward_request(r)
+
+    def _forward_request(self, r):
         conf_file = os.path.join(self.bitcoin_dir, 'bitcoin.conf')
         brpc = BitcoinProxy(btc_conf_file=conf_file)
         method = r['method']
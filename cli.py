@@ -4,9 +4,14 @@ from hashlib import sha256
 from staticjinja import make_site
 
 import click
+import concurrent.futures
 import json
 import os
+import perf
+import reportdb
+import reportstore
 import sys
+import waits
 
 
 @click.group()
@@ -28,17 +33,39 @@ def get_version(impl_name):
 
 @click.command()
 def postprocess():
+    """Store report.json under reports/ and add it to the report database.
+
+    The report is streamed, test by test, into reports/<id>.json.gz with
+    the captured output moved to reports/blobs/, see reportstore.py.
+    """
     if not os.path.exists('report.json'):
         die("No report found to process")
-    report = json.load(open('report.json'))['report']
+    with open('report.json', 'rb') as f:
+        report = reportstore.read_header(f, 'report')
+    # How much of the whole run was spent sleeping and polling
+    with open('report.json', 'rb') as f:
+        summaries = list(reportstore.iter_metrics(f, 'waits', 'report'))
+    if summaries:
+        report['summary']['waits'] = waits.merge(summaries)
     impls = ['eclair', 'lightning', 'lnd', 'ptarmigan']
     report['versions'] = OrderedDict(sorted({i: get_version(i) for i in impls}.items()))
 
     # Any unique random id would do really
     version_string = "_".join([k + "-" + v for k, v in report['versions'].items()])
     report['id'] = sha256(version_string.encode('ASCII')).hexdigest()
-    with open(os.path.join('reports', report['id'] + ".json"), "w") as f:
-        f.write(json.dumps(report))
+
+    db = reportdb.connect()
+    path = os.path.join(reportstore.REPORT_DIR, report['id'] + ".json.gz")
+    with open('report.json', 'rb') as f, reportstore.ReportWriter(path, report) as writer, db:
+        reportdb.add_run(db, report)
+        for test in reportstore.iter_tests(f, 'report'):
+            test = reportstore.extract_output(test)
+            writer.write(test)
+            reportdb.add_tests(db, report['id'], [test])
+
+    # Replaces an uncompressed report of the same versions
+    if os.path.exists(path[:-len('.gz')]):
+        os.remove(path[:-len('.gz')])
 
 
 def group_tests(report):
@@ -50,6 +77,7 @@ def group_tests(report):
         name = splits[0]
         config = splits[1][:-1]
         t['name'] = config
+        t['durations'] = {p: reportdb.phase_duration(t, p) for p in ['setup', 'call', 'teardown']}
         del t['setup']
         del t['teardown']
         if name not in report['tests']:
@@ -73,76 +101,436 @@ def ratio_to_color(ratio):
 
 def load_reports(template):
     reports = []
-    for fname in os.listdir("reports"):
-        with open(os.path.join("reports", fname), 'r') as f:
-            report = json.loads(f.read())
-            ratio = report['summary']['passed'] / report['summary']['num_tests']
-            report['summary']['color'] = ratio_to_color(ratio)
-            reports.append(group_tests(report))
+    for fname in reportstore.report_files():
+        report = reportstore.read_report(os.path.join("reports", fname))
+        report['filename'] = fname
+        ratio = report['summary']['passed'] / report['summary']['num_tests']
+        report['summary']['color'] = ratio_to_color(ratio)
+        reports.append(group_tests(report))
     reports = sorted(reports, key=lambda x: x['created_at'])[::-1]
     return {'reports': reports}
 
 
 def load_report(template):
-    with open(template.filename, 'r') as f:
-        report = json.loads(f.read())
-
+    report = reportstore.read_report(template.filename)
+    report['filename'] = os.path.basename(template.filename)
     return group_tests(report)
 
 
+def sparkline(values, width=100, height=20):
+    """SVG polyline points of `values`, scaled to fit width x height.
+    """
+    if len(values) < 2:
+        return None
+    top = max(values) or 1
+    step = width / (len(values) - 1)
+    return " ".join("{:.1f},{:.1f}".format(i * step, height - height * v / top)
+                    for i, v in enumerate(values))
+
+
+# Number of runs shown in the duration trends of a report page
+TREND_RUNS = 20
+
+
+def add_trends(report):
+    """Attach the call durations of the runs up to this one to each subtest.
+    """
+    history = reportdb.duration_history(reportdb.connect(), last=TREND_RUNS, before=report['created_at'])
+    for name, test in report['tests'].items():
+        for t in test['subtests']:
+            seconds = [d for _, _, d in history.get((name, t['name']), [])]
+            t['trend'] = sparkline(seconds)
+            t['trend_runs'] = len(seconds)
+            t['trend_max'] = max(seconds) if seconds else None
+
+
 def render_report(env, template, **report):
     report_template = env.get_template("_report.html")
     out = "%s/%s.html" % (env.outpath, report['id'])
     for k, v in report['tests'].items():
         ratio = v['success'] / v['total']
         report['tests'][k]['color'] = ratio_to_color(ratio)
+    add_trends(report)
     report_template.stream(**report).dump(out)
 
 
+# Remembers what `html` rendered last time, so it only renders what changed
+SITE_CACHE = '.site-cache.json'
+
+
+def templates_hash():
+    h = sha256()
+    for fname in sorted(os.listdir('templates')):
+        path = os.path.join('templates', fname)
+        if os.path.isfile(path):
+            h.update(fname.encode('UTF-8'))
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def report_summary(report):
+    """The few fields of a report shown on the index.
+    """
+    ratio = report['summary']['passed'] / report['summary']['num_tests']
+    return {
+        'id': report['id'],
+        'created_at': report['created_at'],
+        'summary': {
+            'passed': report['summary']['passed'],
+            'num_tests': report['summary']['num_tests'],
+            'color': ratio_to_color(ratio),
+        },
+    }
+
+
+def render_index(site, summaries):
+    reports = sorted(summaries, key=lambda x: x['created_at'])[::-1]
+    out = os.path.join(site.outpath, 'index.html')
+    site.get_template('index.html').stream(reports=reports).dump(out)
+
+
+# The site of a page rendering process, made on its first page so the
+# templates are only compiled once per process
+_render_site = None
+
+
+def make_report_site():
+    return make_site(outpath='output', staticpaths=('static/',))
+
+
+def render_page(fname):
+    """Render the page of reports/<fname>, returning its index summary.
+    """
+    global _render_site
+    if _render_site is None:
+        _render_site = make_report_site()
+    report = group_tests(reportstore.read_report(os.path.join('reports', fname)))
+    report['filename'] = fname
+    render_report(_render_site, None, **report)
+    return report_summary(report)
+
+
+def render_pages(fnames, jobs=None):
+    """Render the pages of `fnames` on `jobs` processes, one per core by default.
+
+    Yields (fname, summary) pairs as pages are done.
+    """
+    if jobs == 1 or len(fnames) < 2:
+        for fname in fnames:
+            yield fname, render_page(fname)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(render_page, fname): fname for fname in fnames}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
 @click.command()
-def html():
-    global entries
-
-    s = make_site(
-        contexts=[
-            ('index.html', load_reports),
-            ('.*.json', load_report),
-        ],
-        rules=[
-            ('.*.json', render_report),
-        ],
-        outpath='output',
-        staticpaths=('static/',)
-    )
-    s.render()
+@click.option('--force', is_flag=True, help="Render all pages, not just those of new or changed reports")
+@click.option('-j', '--jobs', default=None, type=int, help="Processes rendering pages (default: one per core)")
+def html(force, jobs):
+    """Render the report pages and the index into output/.
+
+    Only reports whose content hash changed since the last build are
+    parsed and rendered, the index is rendered from the summaries cached
+    in SITE_CACHE. Changing a template renders everything again, use
+    --force after a `reindex` to update the duration trends.
+    """
+    cache = {'templates': None, 'reports': {}}
+    if os.path.exists(SITE_CACHE) and not force:
+        with open(SITE_CACHE) as f:
+            cache = json.load(f)
+
+    thash = templates_hash()
+    if cache['templates'] != thash:
+        cache = {'templates': thash, 'reports': {}}
+
+    site = make_report_site()
+    if not os.path.exists(site.outpath):
+        os.makedirs(site.outpath)
+
+    changed = {}
+    seen = set()
+    for fname in reportstore.report_files():
+        seen.add(fname)
+        path = os.path.join('reports', fname)
+        stat = os.stat(path)
+        entry = cache['reports'].get(fname)
+        page = os.path.join(site.outpath, entry['summary']['id'] + '.html') if entry else None
+
+        # Cheap check first, only hash files that were touched
+        if entry and os.path.exists(page) and (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size):
+            continue
+        h = sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if entry and os.path.exists(page) and entry['hash'] == digest:
+            entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+            continue
+        changed[fname] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest}
+
+    for fname, summary in render_pages(sorted(changed), jobs):
+        cache['reports'][fname] = dict(changed[fname], summary=summary)
+    rendered = len(changed)
+
+    removed = set(cache['reports']) - seen
+    removed_ids = set(cache['reports'].pop(fname)['summary']['id'] for fname in removed)
+    # A report that was compressed keeps its page
+    removed_ids -= set(e['summary']['id'] for e in cache['reports'].values())
+    for report_id in removed_ids:
+        page = os.path.join(site.outpath, report_id + '.html')
+        if os.path.exists(page):
+            os.remove(page)
+
+    index = os.path.join(site.outpath, 'index.html')
+    if rendered or removed or not os.path.exists(index):
+        render_index(site, [e['summary'] for e in cache['reports'].values()])
+
+    with open(SITE_CACHE, 'w') as f:
+        json.dump(cache, f)
+    print("Rendered {} report pages, removed {}".format(rendered, len(removed_ids)))
+
+
+def final_metrics(test):
+    """The metrics recorded by the final attempt of a test, see conftest.py.
+    """
+    metadata = test.get('metadata', [])
+    return metadata[-1] if metadata else {}
 
 
-def _get_storage_client():
-    return storage.Client(project=os.getenv("GCP_PROJECT"))
+@click.command()
+@click.option('--last', default=10, help="Number of most recent reports to consider")
+def gossip(last):
+    """Gossip convergence times per implementation and topology size.
+    """
+    reports = load_reports(None)['reports'][:last]
+    times = {}
+    for report in reports:
+        for test in report['tests'].values():
+            for t in test['subtests']:
+                for k, v in final_metrics(t).items():
+                    if not k.startswith('gossip'):
+                        continue
+                    for impl, dists in v['implementations'].items():
+                        conv = dists['convergence']
+                        if conv['count'] == 0:
+                            continue
+                        key = (impl, v['topology'], v['size'])
+                        times.setdefault(key, []).append(conv['median'])
+
+    print("{:<12} {:<14} {:>5} {:>5} {:>10} {:>10}".format(
+        "impl", "topology", "size", "runs", "median", "max"))
+    for (impl, topology, size), v in sorted(times.items()):
+        v = sorted(v)
+        print("{:<12} {:<14} {:>5} {:>5} {:>10.1f} {:>10.1f}".format(
+            impl, str(topology), size, len(v), v[len(v) // 2], v[-1]))
 
 
 @click.command()
-@click.argument('report_id')
-def upload(report_id):
-    filename = report_id + '.json'
+def reindex():
+    """Rebuild the report database from all reports.
+    """
+    db = reportdb.connect()
+    fnames = reportstore.report_files()
+    for fname in fnames:
+        path = os.path.join('reports', fname)
+        with reportstore.open_report(path) as f:
+            report = reportstore.read_header(f)
+        with reportstore.open_report(path) as f, db:
+            reportdb.add_run(db, report)
+            reportdb.add_tests(db, report['id'], reportstore.iter_tests(f))
+    print("Indexed {} reports into {}".format(len(fnames), reportdb.REPORT_DB))
+
+
+@click.command()
+def compress():
+    """Convert uncompressed reports to reports/<id>.json.gz and output blobs.
+    """
+    converted = 0
+    for fname in reportstore.report_files():
+        if not fname.endswith('.json'):
+            continue
+        path = os.path.join('reports', fname)
+        with reportstore.open_report(path) as f:
+            report = reportstore.read_header(f)
+        with reportstore.open_report(path) as f, reportstore.ReportWriter(path + '.gz', report) as writer:
+            for test in reportstore.iter_tests(f):
+                writer.write(reportstore.extract_output(test))
+        os.remove(path)
+        converted += 1
+    print("Compressed {} reports".format(converted))
+
+
+@click.command()
+@click.option('--last', default=100, help="Number of most recent runs to consider")
+@click.option('--test', default=None, help="Only this test, e.g., test_direct_payment")
+@click.option('--impl', multiple=True, help="Only configurations of exactly these implementations, e.g., --impl lnd --impl eclair")
+def query(last, test, impl):
+    """Pass rates per test and configuration from the report database.
+    """
+    wanted = sorted(i.lower() for i in impl)
+    stats = OrderedDict()
+    runs = set()
+    for r in reportdb.final_results(reportdb.connect(), last=last, test=test):
+        if wanted and sorted(reportdb.config_implementations(r['config'])) != wanted:
+            continue
+        runs.add(r['run_id'])
+        s = stats.setdefault((r['test'], r['config']), {'runs': 0, 'passed': 0})
+        s['runs'] += 1
+        s['passed'] += r['outcome'] == 'passed'
+
+    print("{:<28} {:<40} {:>5} {:>7} {:>7}".format("test", "configuration", "runs", "passed", "rate"))
+    for (name, config), s in sorted(stats.items()):
+        print("{:<28} {:<40} {:>5} {:>7} {:>6.0f}%".format(
+            name, config, s['runs'], s['passed'], 100 * s['passed'] / s['runs']))
+    total = sum(s['runs'] for s in stats.values())
+    if total:
+        passed = sum(s['passed'] for s in stats.values())
+        print("{} results from {} runs, {:.0f}% passed".format(total, len(runs), 100 * passed / total))
 
-    client = _get_storage_client()
-    bucket = client.bucket(os.getenv('GCP_STORAGE_BUCKET'))
-    blob = bucket.blob(filename)
 
-    with open(os.path.join("reports", filename)) as f:
-        contents = f.read()
+@click.command()
+@click.option('--last', default=100, help="Number of most recent runs to consider")
+@click.option('--test', default=None, help="Only this test, e.g., test_direct_payment")
+@click.option('--impl', multiple=True, help="Only configurations of exactly these implementations")
+@click.option('--top', default=20, help="Number of test configurations to list")
+def flaky(last, test, impl, top):
+    """Reruns per test and configuration, by the time they wasted.
+
+    Failed tests are rerun (see --reruns in the Makefile), the time spent
+    in attempts before the final one is wasted. Totals per implementation
+    pair follow the list of test configurations. Reports from before the
+    test suite recorded each attempt count a rerun test as rerun once.
+    """
+    wanted = sorted(i.lower() for i in impl)
+    db = reportdb.connect()
+    rows = [r for r in reportdb.rerun_stats(db, last=last, test=test)
+            if not wanted or sorted(reportdb.config_implementations(r['config'])) == wanted]
+    if not any(r['reruns'] for r in rows):
+        print("No reruns in the last {} runs".format(last))
+        return
+
+    print("{:<28} {:<40} {:>5} {:>7} {:>6} {:>7} {:>7} {:>9}".format(
+        "test", "configuration", "runs", "rerun", "flaky", "failed", "reruns", "wasted"))
+    for r in [r for r in rows if r['reruns']][:top]:
+        print("{:<28} {:<40} {:>5} {:>6.0f}% {:>6} {:>7} {:>7} {:>8.0f}s".format(
+            r['test'], r['config'], r['runs'], 100 * r['rerun_runs'] / r['runs'],
+            r['flaky_runs'], r['failed_runs'], r['reruns'], r['wasted']))
+
+    pairs = {}
+    for r in rows:
+        key = "/".join(sorted(reportdb.config_implementations(r['config'])))
+        p = pairs.setdefault(key, {'results': 0, 'rerun_results': 0, 'reruns': 0, 'wasted': 0})
+        p['results'] += r['runs']
+        p['rerun_results'] += r['rerun_runs']
+        p['reruns'] += r['reruns']
+        p['wasted'] += r['wasted']
+
+    print()
+    print("{:<28} {:>8} {:>7} {:>7} {:>9}".format("implementations", "results", "rerun", "reruns", "wasted"))
+    for key, p in sorted(pairs.items(), key=lambda kv: -kv[1]['wasted']):
+        if not p['reruns']:
+            continue
+        print("{:<28} {:>8} {:>6.0f}% {:>7} {:>8.0f}s".format(
+            key, p['results'], 100 * p['rerun_results'] / p['results'], p['reruns'], p['wasted']))
+    print("{:.1f} minutes spent in reruns".format(sum(p['wasted'] for p in pairs.values()) / 60))
+    if not test and not impl:
+        counted = sum(r['reruns'] or 0 for r in reportdb.run_reruns(db, last=last))
+        print("{} reruns counted by pytest-rerunfailures".format(counted))
+
+
+@click.command('perf')
+@click.option('--last', default=30, help="Number of most recent runs to consider")
+@click.option('--test', default=None, help="Only this test, e.g., test_direct_payment")
+@click.option('--impl', multiple=True, help="Only configurations of exactly these implementations")
+@click.option('--threshold', default=3.5, help="Robust z-score above which a duration is an outlier")
+@click.option('--min-slowdown', default=0.2, help="Smallest relative slowdown worth reporting")
+@click.option('--alpha', default=0.05, help="Significance level of the slowdown of a test across configurations")
+def perf_(last, test, impl, threshold, min_slowdown, alpha):
+    """Call durations per test and configuration, and recent slowdowns.
+
+    The latest duration of each configuration is compared to its history,
+    outliers are marked with a *, and each test's latest run is compared
+    to the run before, see perf.py.
+    """
+    wanted = sorted(i.lower() for i in impl)
+    history = OrderedDict(sorted(
+        (k, v) for k, v in reportdb.duration_history(reportdb.connect(), last=last, test=test).items()
+        if not wanted or sorted(reportdb.config_implementations(k[1])) == wanted))
+
+    print("{:<28} {:<40} {:>5} {:>8} {:>8} {:>8} {:>6}".format(
+        "test", "configuration", "runs", "median", "mad", "latest", "z"))
+    outliers = set()
+    for (name, config), runs in history.items():
+        seconds = [d for _, _, d in runs]
+        z = perf.robust_z(seconds[-1], seconds[:-1]) if len(seconds) > 3 else 0.0
+        if z > threshold and seconds[-1] > (1 + min_slowdown) * perf.median(seconds[:-1]):
+            outliers.add((name, config))
+        print("{:<28} {:<40} {:>5} {:>8.1f} {:>8.1f} {:>8.1f} {:>6.1f}{}".format(
+            name, config, len(seconds), perf.median(seconds), perf.mad(seconds), seconds[-1], z,
+            " *" if (name, config) in outliers else ""))
+
+    # Latest two runs of each test, paired by configuration
+    runs = OrderedDict()
+    for (name, config), entries in history.items():
+        for run_id, created_at, seconds in entries:
+            runs.setdefault(name, {}).setdefault((created_at, run_id), {})[config] = seconds
+
+    print()
+    print("Slowdowns since the previous run (p < {}, at least {:.0f}% slower):".format(alpha, 100 * min_slowdown))
+    found = False
+    for name, by_run in runs.items():
+        if len(by_run) < 2:
+            continue
+        keys = sorted(by_run)[-2:]
+        (_, previous_id), (_, latest_id) = keys
+        previous, latest = by_run[keys[0]], by_run[keys[1]]
+        c = perf.compare_runs(previous, latest)
+        if c['p'] >= alpha or c['ratio'] < 1 + min_slowdown:
+            continue
+        found = True
+        print("{:<28} {} -> {}: {}/{} configurations slower, median x{:.2f}, p={:.3f}".format(
+            name, previous_id[:7], latest_id[:7], c['slower'], c['configs'], c['ratio'], c['p']))
+        for config in sorted(latest):
+            if (name, config) in outliers:
+                print("    {:<40} {:.1f}s (outlier)".format(config, latest[config]))
+    if not found:
+        print("None")
 
-    blob.upload_from_string(
-        contents,
-        content_type='application/json')
 
+def _get_storage_client():
+    return storage.Client(project=os.getenv("GCP_PROJECT"))
+
+
+@click.command()
+@click.argument('report_id')
+@click.option('--bucket-dir', default=None, help="Upload into this directory instead of GCP_STORAGE_BUCKET")
+def upload(report_id, bucket_dir):
+    """Upload a report, and the output blobs the bucket doesn't have yet.
+    """
+    if bucket_dir:
+        bucket = reportstore.LocalBucket(bucket_dir)
+    else:
+        client = _get_storage_client()
+        bucket = client.bucket(os.getenv('GCP_STORAGE_BUCKET'))
+
+    blob, uploaded = reportstore.upload_report(bucket, reportstore.report_path(report_id))
     url = blob.public_url
+    print("Uploaded {} and {} new output blobs".format(url, uploaded))
     return url
 
 
 if __name__ == '__main__':
+    cli.add_command(compress)
+    cli.add_command(flaky)
+    cli.add_command(gossip)
     cli.add_command(html)
+    cli.add_command(perf_)
     cli.add_command(postprocess)
+    cli.add_command(query)
+    cli.add_command(reindex)
     cli.add_command(upload)
     cli()
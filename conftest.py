@@ -1,4 +1,16 @@
 import pytest
+import tracing
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    """Give every attempt of a test its own `metrics` dict.
+
+    pytest-rerunfailures reruns a test with the same item, anything
+    recorded by an earlier attempt has to stay where it was put.
+    """
+    item.metrics = {}
+    item.metrics_attached = False
 
 
 # This function is based upon the example of how to
@@ -16,3 +28,23 @@ def pytest_runtest_makereport(item, call):
     # be "setup", "call", "teardown"
 
     setattr(item, "rep_" + rep.when, rep)
+
+    # pytest-json merges all attempts of a test into one entry, keep the
+    # phase durations of each attempt so reruns can be told apart
+    item.metrics.setdefault('durations', {})[rep.when] = rep.duration
+
+    # pytest-json appends the `test_metadata` of each logged report to
+    # the test's `metadata` list in report.json. Attach the metrics to a
+    # single report per attempt: the teardown, or the phase that failed,
+    # since pytest-rerunfailures doesn't log the teardown of an attempt
+    # it reruns. The report is only written at the end of the session,
+    # so what fixtures add to the dict during teardown is included.
+    if (rep.failed or rep.when == "teardown") and not item.metrics_attached:
+        rep.test_metadata = item.metrics
+        item.metrics_attached = True
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    with tracing.span(item.name, 'pytest'):
+        yield
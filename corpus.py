@@ -0,0 +1,113 @@
+""" Stored BOLT11 invoices to check and benchmark the codec against
+
+corpus/synthetic.json holds invoices we signed ourselves, one batch per
+kind of invoice the codec has to handle, and can be regenerated with
+`python bench.py corpus`. corpus/<implementation>.json hold invoices
+returned by that implementation's `invoice()`, recorded by
+`UPDATE_CORPUS=1 py.test test.py -k test_invoice_corpus`.
+"""
+from decimal import Decimal
+from lnaddr import LnAddr, lnencode
+
+import json
+import os
+import random
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# Any key will do, we only sign invoices to decode them again
+PRIVKEY = 'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+
+FALLBACKS = [
+    '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T',
+    '3EktnHQD7RiAE6uzMj2ZifT9YgRrkSgzQX',
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4',
+    'bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3',
+]
+
+
+def random_route(rnd):
+    return (
+        bytes([2]) + bytes(rnd.getrandbits(8) for _ in range(32)),
+        bytes(rnd.getrandbits(8) for _ in range(8)),
+        rnd.randint(0, 10**6),
+        rnd.randint(6, 144),
+    )
+
+
+def synthetic_tags(kind, rnd):
+    if kind == 'routes':
+        return [('d', 'routed')] + [('r', random_route(rnd)) for _ in range(rnd.randint(1, 10))]
+    elif kind == 'fallback':
+        return [('d', 'fallback'), ('f', rnd.choice(FALLBACKS))]
+    elif kind == 'long_description':
+        # 639 bytes is the most a tagged field can hold
+        return [('d', 'x' * rnd.randint(300, 639))]
+    elif kind == 'description_hash':
+        return [('h', 'long description ' * rnd.randint(1, 100))]
+    elif kind in ('amount', 'no_amount'):
+        return [('d', 'coffee'), ('x', rnd.randint(60, 86400))]
+    raise ValueError("Unknown kind of invoice {}".format(kind))
+
+
+def make_synthetic(num=50, seed=0):
+    """ `num` invoices of each kind, on mainnet so fallbacks can be encoded
+    """
+    rnd = random.Random(seed)
+    entries = []
+    for kind in ['routes', 'fallback', 'long_description', 'description_hash', 'amount', 'no_amount']:
+        for _ in range(num):
+            addr = LnAddr(
+                paymenthash=bytes(rnd.getrandbits(8) for _ in range(32)),
+                amount=None if kind == 'no_amount' else Decimal(rnd.randint(1, 10**8)) / 10**11,
+                currency='bc',
+                tags=synthetic_tags(kind, rnd),
+                date=1500000000 + rnd.randint(0, 10**8),
+            )
+            entries.append({'kind': kind, 'bolt11': lnencode(addr, PRIVKEY)})
+    return entries
+
+
+def save_corpus(source, entries):
+    """ Add `entries` to corpus/<source>.json, skipping known invoices
+    """
+    path = os.path.join(CORPUS_DIR, source + '.json')
+    existing = []
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = json.load(f)
+    known = set(e['bolt11'] for e in existing)
+    existing += [e for e in entries if e['bolt11'] not in known]
+
+    if not os.path.exists(CORPUS_DIR):
+        os.makedirs(CORPUS_DIR)
+    with open(path, 'w') as f:
+        json.dump(existing, f, indent=2)
+    return len(existing)
+
+
+def load_corpus():
+    """ All stored invoices, each entry tagged with its `source` file
+    """
+    entries = []
+    if not os.path.exists(CORPUS_DIR):
+        return entries
+    for fname in sorted(os.listdir(CORPUS_DIR)):
+        if not fname.endswith('.json'):
+            continue
+        with open(os.path.join(CORPUS_DIR, fname)) as f:
+            for e in json.load(f):
+                e['source'] = fname[:-5]
+                entries.append(e)
+    return entries
+
+
+def decoded_fields(addr):
+    """ Everything a decoder extracts from an invoice, in a comparable form
+    """
+    return (
+        addr.currency, addr.amount, addr.date, addr.paymenthash,
+        list(addr.tags), [(t, v.bin) for t, v in addr.unknown_tags],
+        addr.min_final_cltv_expiry, addr.pubkey.serialize(),
+    )
@@ -3,8 +3,11 @@ from ephemeral_port_reserve import reserve
 from lnaddr import lndecode
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from utils import TailableProc
+from utils import TailableProc, at_loop_close
+from waits import sleep
 
+import aiohttp
+import asyncio
 import json
 import logging
 import os
@@ -12,7 +15,6 @@ import psutil
 import re
 import requests
 import shutil
-import time
 
 
 def requests_retry_session(
@@ -124,6 +126,8 @@ class EclairNode(object):
                               port=lightning_port)
         self.rpc = EclairRpc(
             'http://localhost:{}'.format(self.daemon.rpc_port))
+        self.aio = AsyncEclairNode(
+            'http://localhost:{}'.format(self.daemon.rpc_port))
         self.logger = logging.getLogger('eclair-node({})'.format(lightning_port))
 
     def peers(self):
@@ -146,9 +150,14 @@ class EclairNode(object):
 
         # Eclair seems to grab funds from the block, so give it a
         # chance to see it
-        time.sleep(1)
+        sleep(1)
         bitcoind.rpc.generate(1)
 
+    def has_funds(self, satoshis):
+        # Eclair's wallet lives in bitcoind, so ask bitcoind
+        received = self.bitcoin.rpc.getreceivedbyaddress(self.getaddress(), 1)
+        return received * 10**8 >= satoshis
+
     def ping(self):
         """ Simple liveness test to see if the node is up and running
 
@@ -199,7 +208,7 @@ class EclairNode(object):
         return self.rpc._call('connect', [node_id, host, port])
 
     def block_sync(self, blockhash):
-        time.sleep(1)
+        sleep(1)
 
     def info(self):
         r = self.rpc._call('getinfo', [])
@@ -210,9 +219,9 @@ class EclairNode(object):
 
     def restart(self):
         self.daemon.stop()
-        time.sleep(5)
+        sleep(5)
         self.daemon.start()
-        time.sleep(1)
+        sleep(1)
 
     def check_route(self, node_id, amount):
         try:
@@ -260,3 +269,57 @@ class EclairRpc(object):
 
     def help(self):
         return self._call('help', [])
+
+
+class AsyncEclairNode(object):
+    """The asyncio interface of an EclairNode, using aiohttp.
+
+    An aiohttp session is bound to the event loop it was created on, so
+    we open a new one whenever we are called from a different loop, and
+    close it along with its loop.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.loop = None
+        self.session = None
+
+    async def call(self, method, params):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            await self.close()
+            self.session = aiohttp.ClientSession(auth=aiohttp.BasicAuth('user', 'rpcpass'))
+            self.loop = loop
+            at_loop_close(self.close)
+
+        data = {'method': method, 'params': params}
+        async with self.session.post(self.url, json=data) as reply:
+            if reply.status != 200:
+                raise ValueError("Server returned an unknown error: {} ({})".format(
+                    reply.status, await reply.text()))
+            r = await reply.json()
+
+        if 'error' in r:
+            raise ValueError('Error calling {}: {}'.format(method, r['error']))
+        return r['result']
+
+    async def info(self):
+        r = await self.call('getinfo', [])
+        return {
+            'id': r['nodeId'],
+            'blockheight': r['blockHeight'],
+        }
+
+    async def invoice(self, amount):
+        return await self.call("receive", [amount, "invoice1"])
+
+    async def send(self, req):
+        result = await self.call("send", [req])
+        if 'failures' in result:
+            raise ValueError("Failed to send payment: {}".format(result))
+        return result['paymentPreimage']
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.loop = self.session = None
@@ -5,7 +5,6 @@ import os
 import sys
 import tempfile
 import threading
-import time
 import queue
 
 from electrum import constants, simple_config, util
@@ -22,6 +21,7 @@ from electrumx.server.env import Env
 
 from ephemeral_port_reserve import reserve
 from utils import BITCOIND_CONFIG
+from waits import polling, sleep
 
 bh2u = lambda x: binascii.hexlify(x).decode('ascii')
 
@@ -113,6 +113,7 @@ class ElectrumNode:
         self.lightning_port = lightning_port
         self.daemon = ElectrumDaemon(self.electrumx, lightning_port)
         self.broadcasted_encumbered_txs = queue.Queue()
+        self.aio = AsyncElectrumNode(self)
 
     @property
     def wallet(self):
@@ -142,6 +143,13 @@ class ElectrumNode:
         assert chan.node_id == bytes.fromhex(node_id), (bh2u(chan.node_id), node_id)
         return chan
 
+    def getaddress(self):
+        return self.wallet.get_unused_address()
+
+    def has_funds(self, satoshis):
+        matured, unconfirmed, unmatured = self.wallet.get_balance()
+        return matured + unmatured >= satoshis
+
     def addfunds(self, bitcoind, satoshis):
         self.logger.info("addfunds")
         addr = self.wallet.get_unused_address()
@@ -151,12 +159,13 @@ class ElectrumNode:
         assert addr is not None
         bitcoind.rpc.sendtoaddress(addr, float(satoshis) / 10**8)
         bitcoind.rpc.generate(1)
-        while True:
-            matured, unconfirmed, unmatured = self.wallet.get_addr_balance(addr)
-            if matured + unmatured != 0:
-                break
-            self.logger.info('still waiting, have {} {} {}'.format(matured, unconfirmed, unmatured))
-            time.sleep(1)
+        with polling():
+            while True:
+                matured, unconfirmed, unmatured = self.wallet.get_addr_balance(addr)
+                if matured + unmatured != 0:
+                    break
+                self.logger.info('still waiting, have {} {} {}'.format(matured, unconfirmed, unmatured))
+                sleep(1)
         self.logger.info("funds added!")
 
     def ping(self):
@@ -221,12 +230,12 @@ class ElectrumNode:
 
     def block_sync(self, blockhash):
         self.logger.info("block_sync")
-        time.sleep(1)
+        sleep(1)
 
     def restart(self):
         self.logger.info("restart")
         self.daemon.stop()
-        time.sleep(5)
+        sleep(5)
         self.daemon = ElectrumDaemon(self.electrumx, self.lightning_port)
         self.daemon.start()
 
@@ -273,3 +282,34 @@ class ElectrumNode:
         async def f():
             return {txid: addr_sync.get_tx_height(txid).height for txid in txs}
         return asyncio.run_coroutine_threadsafe(f(), self.wallet.network.asyncio_loop).result(seconds)
+
+
+class AsyncElectrumNode(object):
+    """The asyncio interface of an ElectrumNode.
+
+    The wallet runs its own event loop on another thread, so we await
+    its futures through `asyncio.wrap_future` rather than blocking on
+    them. Calls the wallet only offers synchronously run on the default
+    executor.
+    """
+
+    def __init__(self, node):
+        self.node = node
+
+    async def info(self):
+        return await asyncio.get_event_loop().run_in_executor(None, self.node.info)
+
+    async def invoice(self, amount):
+        return await asyncio.get_event_loop().run_in_executor(None, self.node.invoice, amount)
+
+    async def send(self, req):
+        wallet = self.node.wallet
+        addr, peer, fut = wallet.lnworker.pay(req)
+        await asyncio.wait_for(asyncio.wrap_future(fut), 5)
+        coro = peer.payment_preimages[addr.paymenthash].get()
+        fut = asyncio.run_coroutine_threadsafe(coro, wallet.network.asyncio_loop)
+        preimage = await asyncio.wait_for(asyncio.wrap_future(fut), 5)
+        return bh2u(preimage)
+
+    async def close(self):
+        pass
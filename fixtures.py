@@ -2,16 +2,33 @@ from btcproxy import ProxiedBitcoinD
 from ephemeral_port_reserve import reserve
 from concurrent import futures
 from electrumutils import ElectrumX
+from invoicepool import InvoicePool
+from miner import Miner
 
 import os
 import pytest
 import tempfile
 import logging
 import shutil
+import tracing
+import waits
 
 
 TEST_DIR = tempfile.mkdtemp(prefix='lightning-')
 TEST_DEBUG = os.getenv("TEST_DEBUG", "0") == "1"
+TEST_SCALE = os.getenv("TEST_SCALE", "0") == "1"
+UPDATE_CORPUS = os.getenv("UPDATE_CORPUS", "0") == "1"
+TEST_TRACE_RPC = os.getenv("TEST_TRACE_RPC", "0") == "1"
+# Seconds between samples of the nodes' CPU and memory use, 0 to disable
+TEST_SAMPLE_INTERVAL = float(os.getenv("TEST_SAMPLE_INTERVAL", "0"))
+# Directory to write a Chrome trace of each test to, see tracing.py
+TEST_TRACE_DIR = os.getenv("TEST_TRACE_DIR")
+
+# Node methods that get a span in the traces
+TRACED_METHODS = [
+    'addfunds', 'block_sync', 'check_channel', 'check_route', 'connect', 'getaddress',
+    'has_funds', 'id', 'info', 'invoice', 'openchannel', 'ping', 'restart', 'send',
+]
 
 
 # A dict in which we count how often a particular test has run so far. Used to
@@ -31,6 +48,7 @@ class NodeFactory(object):
         self.btcd = btcd
         self.electrumx = None
         self.electrumx_directory = electrumx_directory
+        self.invoice_pools = {}
 
     def get_electrumx(self):
         if self.electrumx is None:
@@ -38,24 +56,63 @@ class NodeFactory(object):
             self.electrumx.start()
         return self.electrumx
 
-    def get_node(self, implementation):
+    def create_node(self, implementation):
+        """Set up a node of `implementation`, without starting its daemon.
+        """
         node_id = self.next_id
         self.next_id += 1
 
         lightning_dir = os.path.join(
             TEST_DIR, self.testname, "node-{}/".format(node_id))
-        port = reserve()
-
-        node = implementation(lightning_dir, port, self.bitcoind,
+        node = implementation(lightning_dir, reserve(), self.bitcoind,
                               executor=self.executor, node_id=node_id,
                               get_electrumx=self.get_electrumx)
         self.nodes.append(node)
 
         node.btcd = self.btcd
-        node.daemon.start()
+        if TEST_TRACE_RPC and hasattr(node, 'enable_tracing'):
+            node.enable_tracing()
+        if TEST_SAMPLE_INTERVAL and hasattr(node.daemon, 'enable_sampling'):
+            node.daemon.enable_sampling(TEST_SAMPLE_INTERVAL)
+        if TEST_TRACE_DIR:
+            tracing.trace_methods(node, TRACED_METHODS, 'node')
         return node
 
+    def start_node(self, node):
+        with tracing.span('get_node', 'node', implementation=node.__class__.__name__):
+            node.daemon.start()
+        return node
+
+    def get_node(self, implementation):
+        return self.start_node(self.create_node(implementation))
+
+    def get_nodes(self, implementation, num_nodes):
+        """Create `num_nodes` nodes and start their daemons concurrently.
+
+        Startup of a single daemon can take several seconds, so for
+        larger networks we let the executor start them in parallel.
+        """
+        nodes = [self.create_node(implementation) for _ in range(num_nodes)]
+        list(self.executor.map(self.start_node, nodes))
+        return nodes
+
+    def invoice_pool(self, node, amount, size=5):
+        """The pool of ready-made invoices of `node` for `amount`.
+
+        The pool starts filling in the background on first use, so ask
+        for it early and take invoices from it when it's time to pay.
+        Some implementations add route hints for their channels, so the
+        payee's channels should be open by then.
+        """
+        key = (node, amount)
+        if key not in self.invoice_pools:
+            self.invoice_pools[key] = InvoicePool(node, amount, self.executor, size)
+            self.invoice_pools[key].fill()
+        return self.invoice_pools[key]
+
     def killall(self):
+        for pool in self.invoice_pools.values():
+            pool.close()
         if self.electrumx:
             self.electrumx.kill()
             self.electrumx.wait()
@@ -102,11 +159,55 @@ def test_name(request):
     yield request.function.__name__
 
     
+@pytest.fixture(autouse=True)
+def trace(request):
+    """Record a timeline of the test if TEST_TRACE_DIR is set.
+
+    Being autouse, this is set up before and torn down after the other
+    fixtures, so starting and stopping bitcoind and the nodes is part of
+    the trace.
+    """
+    if not TEST_TRACE_DIR:
+        yield None
+        return
+
+    tracer = tracing.start()
+    yield tracer
+    tracing.stop()
+
+    if not os.path.exists(TEST_TRACE_DIR):
+        os.makedirs(TEST_TRACE_DIR)
+    path = os.path.join(TEST_TRACE_DIR, "{}.json".format(request.node.name))
+    tracer.export(path)
+    request.node.metrics['trace'] = path
+
+
+@pytest.fixture(autouse=True)
+def wait_accounting(request):
+    """Split the test's time into fixed sleeps, polling and work, see waits.py.
+    """
+    waits.start()
+    yield
+    stats = waits.stop()
+    request.node.metrics['waits'] = stats.summary()
+
+
+@pytest.fixture
+def metrics(request):
+    """A dict of measurements that ends up in the test's entry in report.json.
+
+    Each attempt of the test adds one to the entry's `metadata` list, see
+    conftest.py.
+    """
+    yield request.node.metrics
+
+
 @pytest.fixture()
 def bitcoind(directory):
     proxyport = reserve()
     btc = ProxiedBitcoinD(bitcoin_dir=os.path.join(directory, "bitcoind"), proxyport=proxyport)
-    btc.start()
+    with tracing.span('bitcoind.start', 'bitcoind'):
+        btc.start()
     bch_info = btc.rpc.getblockchaininfo()
     w_info = btc.rpc.getwalletinfo()
     # Make sure we have segwit and some funds
@@ -132,6 +233,16 @@ def bitcoind(directory):
     btc.proc.wait()
 
 
+@pytest.fixture
+def miner(bitcoind):
+    miner = Miner(bitcoind)
+    miner.start()
+
+    yield miner
+
+    miner.stop()
+
+
 @pytest.fixture(scope="module")
 def btcd():
     btcd = BtcD()
@@ -151,5 +262,18 @@ def node_factory(request, bitcoind, directory):
     executor = futures.ThreadPoolExecutor(max_workers=20)
     node_factory = NodeFactory(request._pyfuncitem.name, executor, bitcoind, None, electrumx_directory=directory)
     yield node_factory
-    node_factory.killall()
+    with tracing.span('killall', 'node'):
+        node_factory.killall()
     executor.shutdown(wait=False)
+
+    traces = {n.daemon.port: n.trace.summary() for n in node_factory.nodes
+              if getattr(n, 'trace', None) is not None}
+    if traces:
+        request.node.metrics['rpc_trace'] = traces
+
+    resources = {}
+    for n in node_factory.nodes:
+        if getattr(n.daemon, 'sampler', None) is not None:
+            resources[n.daemon.port] = dict(n.daemon.sampler.summary(), implementation=n.__class__.__name__)
+    if resources:
+        request.node.metrics['resources'] = resources
@@ -0,0 +1,111 @@
+""" Gossip propagation instrumentation
+
+Polls the nodes' view of the network graph (`getchannels`/`getnodes`)
+and remembers when each node first learned about each channel and
+node, so that convergence becomes a number rather than a timeout.
+"""
+from utils import wait_for
+
+import logging
+import time
+
+
+def distribution(values):
+    """Summarize a list of durations in seconds.
+    """
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {
+        'count': len(values),
+        'min': values[0],
+        'median': percentile(0.5),
+        'p90': percentile(0.9),
+        'max': values[-1],
+    }
+
+
+class GossipMonitor(object):
+    """Track when `nodes` learn about channels and nodes.
+
+    All timestamps are relative to `start_time`, the `time.time()` of
+    the event that starts the gossip you want to measure, e.g., the
+    channel confirmations or a new connection. It defaults to the
+    creation of the monitor, so create it right before that event if
+    you don't pass the time. What the nodes already know by the first
+    poll is counted as learned at that time.
+    """
+
+    def __init__(self, nodes, executor=None, topology=None, start_time=None):
+        self.nodes = nodes
+        self.executor = executor
+        self.topology = topology
+        self.start_time = start_time if start_time is not None else time.time()
+        self.first_poll = None
+        self.channels_seen = [{} for _ in nodes]
+        self.nodes_seen = [{} for _ in nodes]
+        self.converged_at = [None] * len(nodes)
+
+    def _poll_node(self, i, num_nodes, num_channels):
+        node = self.nodes[i]
+        now = time.time() - self.start_time
+        channels = node.getchannels() if num_channels is not None else []
+        nodes = node.getnodes() if num_nodes is not None else []
+        for c in channels:
+            self.channels_seen[i].setdefault(c, now)
+        for n in nodes:
+            self.nodes_seen[i].setdefault(n, now)
+
+        done = ((num_channels is None or len(channels) == num_channels) and
+                (num_nodes is None or len(nodes) == num_nodes))
+        if done and self.converged_at[i] is None:
+            self.converged_at[i] = now
+        return done
+
+    def poll(self, num_nodes=None, num_channels=None):
+        """Poll all nodes once, returns True if all of them converged.
+        """
+        if self.first_poll is None:
+            self.first_poll = time.time() - self.start_time
+        pending = [i for i in range(len(self.nodes)) if self.converged_at[i] is None]
+        if self.executor:
+            done = list(self.executor.map(
+                lambda i: self._poll_node(i, num_nodes, num_channels), pending))
+        else:
+            done = [self._poll_node(i, num_nodes, num_channels) for i in pending]
+        logging.debug("Gossip converged on {}/{} nodes".format(
+            len(self.nodes) - len(pending) + sum(done), len(self.nodes)))
+        return all(done)
+
+    def wait_converged(self, num_nodes=None, num_channels=None, timeout=120, interval=1):
+        wait_for(lambda: self.poll(num_nodes, num_channels),
+                 interval=interval, timeout=timeout)
+
+    def summary(self):
+        """Convergence and propagation times grouped by implementation.
+
+        `convergence` is the time each node took to see the full graph,
+        `propagation` the time it took to learn each individual channel
+        or node. No time is below `first_poll`.
+        """
+        impls = {}
+        for i, node in enumerate(self.nodes):
+            impl = impls.setdefault(node.displayName, {'convergence': [], 'propagation': []})
+            if self.converged_at[i] is not None:
+                impl['convergence'].append(self.converged_at[i])
+            impl['propagation'] += list(self.channels_seen[i].values())
+            impl['propagation'] += list(self.nodes_seen[i].values())
+
+        return {
+            'topology': self.topology,
+            'size': len(self.nodes),
+            'first_poll': self.first_poll,
+            'implementations': {
+                name: {k: distribution(v) for k, v in times.items()}
+                for name, times in impls.items()
+            },
+        }
@@ -0,0 +1,85 @@
+""" Invoices generated ahead of time
+
+Creating an invoice is an RPC round-trip to the payee, which we don't want
+to count towards the time it takes to make a payment. An `InvoicePool`
+generates a number of invoices of a given amount in the background on an
+executor. Taking an invoice doesn't top the pool up again unless asked
+to, so no `invoice` call runs while the payment is being made.
+"""
+import logging
+import queue
+import threading
+import time
+
+
+class InvoicePool(object):
+
+    def __init__(self, node, amount, executor, size=5):
+        self.node = node
+        self.amount = amount
+        self.executor = executor
+        self.size = size
+        self.invoices = queue.Queue()
+        self.lock = threading.Lock()
+        self.filling = None
+        self.closed = False
+        self.logger = logging.getLogger('invoicepool')
+
+    def fill(self):
+        """Top up the pool in the background, unless that's already happening.
+
+        A single job generates the invoices one after the other, since
+        not all implementations like concurrent `invoice` calls. Errors
+        of a previous job are raised here.
+        """
+        with self.lock:
+            if self.filling is not None and self.filling.done():
+                error = self.filling.exception()
+                self.filling = None
+                if error:
+                    raise error
+            if self.filling is None and not self.closed:
+                self.filling = self.executor.submit(self.generate)
+
+    def generate(self):
+        while not self.closed and self.invoices.qsize() < self.size:
+            self.invoices.put(self.node.invoice(self.amount))
+        self.logger.debug("Pool for {} msat at node {} is full".format(
+            self.amount, self.node.daemon.port))
+
+    def wait_full(self, timeout=60):
+        """Wait until the pool is full, raising the errors of generating it.
+        """
+        self.fill()
+        with self.lock:
+            filling = self.filling
+        if filling is not None:
+            filling.result(timeout)
+
+    def get(self, timeout=60, refill=False):
+        """Take an invoice from the pool, waiting for one if it is empty.
+
+        Only tops the pool up again in the background with `refill`.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                req = self.invoices.get(block=False)
+                break
+            except queue.Empty:
+                pass
+            self.fill()
+            try:
+                req = self.invoices.get(timeout=1)
+                break
+            except queue.Empty:
+                if time.time() > deadline:
+                    raise TimeoutError("No invoice for {} msat was generated".format(self.amount))
+        if refill:
+            self.fill()
+        return req
+
+    def close(self):
+        """Stop generating invoices, letting a running `invoice` call finish.
+        """
+        self.closed = True
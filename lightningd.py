@@ -1,9 +1,13 @@
 from lightning import LightningRpc
-from utils import TailableProc
+from utils import CountingSocket, RpcTrace, TailableProc, stream_rpc
+from waits import polling, sleep
 
+import asyncio
+import itertools
 import json
 import logging
 import os
+import threading
 import time
 
 
@@ -46,7 +50,7 @@ class LightningD(TailableProc):
     def start(self):
         TailableProc.start(self)
         self.wait_for_log("Server started with public key")
-        time.sleep(5)
+        sleep(5)
         logging.info("LightningD started")
 
     def stop(self):
@@ -65,22 +69,66 @@ class LightningNode(object):
                                  port=lightning_port)
         socket_path = os.path.join(lightning_dir, "lightning-rpc").format(
             node_id)
-        self.invoice_count = 0
+        # Invoice pools may ask for invoices from another thread, `next`
+        # hands out unique labels nonetheless.
+        self.invoice_count = itertools.count()
         self.logger = logging.getLogger('lightning-node({})'.format(lightning_port))
 
         self.rpc = LightningRpc(socket_path, self.executor)
 
+        # Set by `enable_tracing`
+        self.trace = None
+        self.received = threading.local()
+
         orig_call = self.rpc._call
 
         def rpc_call(method, args):
-            self.logger.debug("Calling {} with arguments {}".format(method, json.dumps(args, indent=4, sort_keys=True)))
-            r = orig_call(method, args)
-            self.logger.debug("Call returned {}".format(json.dumps(r, indent=4, sort_keys=True)))
+            # Pretty-printing large replies in polling loops is expensive,
+            # only do it if someone is going to read it.
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if self.trace is None and not debug:
+                return orig_call(method, args)
+
+            if debug:
+                self.logger.debug("Calling {} with arguments {}".format(method, json.dumps(args, indent=4, sort_keys=True)))
+            start_time = time.time()
+            self.received.bytes = 0
+            try:
+                r = orig_call(method, args)
+            except Exception as e:
+                if self.trace is not None:
+                    self.trace.record(method, args, start_time, self.received.bytes, error=e)
+                raise
+            if self.trace is not None:
+                self.trace.record(method, args, start_time, self.received.bytes)
+            if debug:
+                self.logger.debug("Call returned {}".format(json.dumps(r, indent=4, sort_keys=True)))
             return r
 
         self.rpc._call = rpc_call
+        self.aio = AsyncLightningNode(self, socket_path)
         self.myid = None
 
+    def enable_tracing(self, maxlen=10000):
+        """Record the last `maxlen` RPC calls in `self.trace`.
+
+        Replies are sized by the bytes read from the socket, encoding
+        them again would cost as much as the pretty-printing does.
+        """
+        if self.trace is None:
+            orig_readobj = self.rpc._readobj
+
+            def readobj(sock, *args, **kwargs):
+                sock = CountingSocket(sock)
+                try:
+                    return orig_readobj(sock, *args, **kwargs)
+                finally:
+                    self.received.bytes = getattr(self.received, 'bytes', 0) + sock.received
+
+            self.rpc._readobj = readobj
+        self.trace = RpcTrace(maxlen)
+        return self.trace
+
     def peers(self):
         return [p['id'] for p in self.rpc.listpeers()['peers']]
 
@@ -107,9 +155,14 @@ class LightningNode(object):
         addr = self.getaddress()
         txid = bitcoind.rpc.sendtoaddress(addr, float(satoshis) / 10**8)
         bitcoind.rpc.getrawtransaction(txid)
-        while len(self.rpc.listfunds()['outputs']) == 0:
-            time.sleep(1)
-            bitcoind.rpc.generate(1)
+        with polling():
+            while len(self.rpc.listfunds()['outputs']) == 0:
+                sleep(1)
+                bitcoind.rpc.generate(1)
+
+    def has_funds(self, satoshis):
+        outputs = self.rpc.listfunds()['outputs']
+        return sum(o['value'] for o in outputs) >= satoshis
 
     def ping(self):
         """ Simple liveness test to see if the node is up and running
@@ -177,8 +230,7 @@ class LightningNode(object):
         return set([n['nodeid'] for n in self.rpc.listnodes()['nodes']])
 
     def invoice(self, amount):
-        invoice = self.rpc.invoice(amount, "invoice%d" % (self.invoice_count), "description")
-        self.invoice_count += 1
+        invoice = self.rpc.invoice(amount, "invoice%d" % next(self.invoice_count), "description")
         return invoice['bolt11']
 
     def send(self, req):
@@ -196,13 +248,13 @@ class LightningNode(object):
         }
 
     def block_sync(self, blockhash):
-        time.sleep(1)
+        sleep(1)
 
     def restart(self):
         self.daemon.stop()
-        time.sleep(5)
+        sleep(5)
         self.daemon.start()
-        time.sleep(1)
+        sleep(1)
 
     def check_route(self, node_id, amount):
         try:
@@ -212,3 +264,48 @@ class LightningNode(object):
                 return False
             raise
         return True
+
+
+class AsyncLightningNode(object):
+    """The asyncio interface of a LightningNode, talking JSON-RPC to the
+    unix socket of lightningd directly.
+    """
+
+    def __init__(self, node, socket_path):
+        self.node = node
+        self.socket_path = socket_path
+
+    async def call(self, method, params=None):
+        start_time = time.time()
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        resp, size = await stream_rpc(reader, writer, method, params if params else {})
+        if 'error' in resp:
+            if self.node.trace is not None:
+                self.node.trace.record(method, params, start_time, size, error=resp['error'])
+            raise ValueError("RPC call failed: {}, method: {}, payload: {}".format(
+                resp['error'], method, params))
+        if self.node.trace is not None:
+            self.node.trace.record(method, params, start_time, size)
+        return resp['result']
+
+    async def info(self):
+        r = await self.call('getinfo')
+        return {
+            'id': r['id'],
+            'blockheight': r['blockheight'],
+        }
+
+    async def invoice(self, amount):
+        invoice = await self.call('invoice', {
+            'msatoshi': amount,
+            'label': "invoice%d" % next(self.node.invoice_count),
+            'description': "description",
+        })
+        return invoice['bolt11']
+
+    async def send(self, req):
+        result = await self.call('pay', {'bolt11': req})
+        return result['payment_preimage']
+
+    async def close(self):
+        pass
@@ -6,6 +6,8 @@ from decimal import Decimal
 
 import base58
 import bitstring
+import concurrent.futures
+import functools
 import hashlib
 import math
 import re
@@ -156,7 +158,11 @@ def pull_tagged(stream):
     length = stream.read(5).uint * 32 + stream.read(5).uint
     return (CHARSET[tag], stream.read(length * 5), stream)
 
-def lnencode(addr, privkey):
+def lnencode_bitstring(addr, privkey):
+    """ Reference encoder working on bitstring objects
+
+    Kept to check and benchmark `lnencode` against.
+    """
     if addr.amount:
         amount = Decimal(str(addr.amount))
         # We can only send down to millisatoshi.
@@ -228,17 +234,100 @@ def lnencode(addr, privkey):
 
     return bech32_encode(hrp, bitarray_to_u5(data))
 
+def parsed_attribute(name):
+    """ Attribute stored in slot `_name`, filled in by parsing the tagged
+    fields the first time it is read or written.
+    """
+    slot = '_' + name
+
+    def get(self):
+        if self._fields is not None:
+            self._parse_fields()
+        return getattr(self, slot)
+
+    def set(self, value):
+        if self._fields is not None:
+            self._parse_fields()
+        setattr(self, slot, value)
+    return property(get, set)
+
+def signed_attribute(name):
+    """ Attribute stored in slot `_name`, filled in by checking the
+    signature the first time it is read or written.
+    """
+    slot = '_' + name
+
+    def get(self):
+        if self._raw is not None:
+            self._check_signature()
+        return getattr(self, slot)
+
+    def set(self, value):
+        if self._raw is not None:
+            self._check_signature()
+        setattr(self, slot, value)
+    return property(get, set)
+
 class LnAddr(object):
+    """ A BOLT11 invoice
+
+    `lndecode` only decodes the prefix and the timestamp up front. The
+    tagged fields are parsed the first time one of them is used, and the
+    signature is only checked, or the pubkey recovered, when `pubkey` or
+    `signature` is first read, raising ValueError at that point if it is
+    invalid.
+    """
+    __slots__ = ('date', 'currency', 'amount', '_tags', '_unknown_tags',
+                 '_paymenthash', '_min_final_cltv_expiry', '_pubkey',
+                 '_signature', '_fields', '_raw')
+
     def __init__(self, paymenthash=None, amount=None, currency='bc', tags=None, date=None):
         self.date = int(time.time()) if not date else int(date)
-        self.tags = [] if not tags else tags
-        self.unknown_tags = []
-        self.paymenthash = paymenthash
-        self.signature = None
-        self.pubkey = None
         self.currency = currency
         self.amount = amount
-        self.min_final_cltv_expiry = None
+        self._tags = [] if not tags else tags
+        self._unknown_tags = []
+        self._paymenthash = paymenthash
+        self._min_final_cltv_expiry = None
+        self._pubkey = None
+        self._signature = None
+        # (tag, words) pairs not parsed yet
+        self._fields = None
+        # (hrp, data, signature bytes) not checked yet
+        self._raw = None
+
+    tags = parsed_attribute('tags')
+    unknown_tags = parsed_attribute('unknown_tags')
+    min_final_cltv_expiry = parsed_attribute('min_final_cltv_expiry')
+    pubkey = signed_attribute('pubkey')
+    signature = signed_attribute('signature')
+
+    @property
+    def paymenthash(self):
+        if self._fields is None:
+            return self._paymenthash
+        # Scanning invoices for their payment hash shouldn't cost a full
+        # parse, just find the last valid `p` field.
+        for tag, words in reversed(self._fields):
+            if tag == 'p' and len(words) == 52:
+                return u5_to_bytes(words)
+        return None
+
+    @paymenthash.setter
+    def paymenthash(self, value):
+        if self._fields is not None:
+            self._parse_fields()
+        self._paymenthash = value
+
+    def _parse_fields(self):
+        fields, self._fields = self._fields, None
+        parse_tagged_fields(self, fields)
+
+    def _check_signature(self):
+        if self._fields is not None:
+            self._parse_fields()
+        check_signature(self, *self._raw)
+        self._raw = None
 
     def __str__(self):
         return "LnAddr[{}, amount={}{} tags=[{}]]".format(
@@ -247,7 +336,34 @@ class LnAddr(object):
             ", ".join([k + '=' + str(v) for k, v in self.tags])
         )
 
-def lndecode(a):
+class FrozenLnAddr(LnAddr):
+    """ Read-only copy of an LnAddr, safe to hand out to several callers
+
+    Copying parses all fields and checks the signature. Tags are turned
+    into tuples and any attempt to set an attribute raises
+    AttributeError.
+    """
+    __slots__ = ()
+
+    def __init__(self, addr):
+        addr.pubkey
+        for k in LnAddr.__slots__:
+            v = getattr(addr, k)
+            if k in ('_tags', '_unknown_tags'):
+                v = tuple(v)
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenLnAddr is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("FrozenLnAddr is read-only")
+
+def lndecode_bitstring(a):
+    """ Reference decoder working on bitstring objects
+
+    Kept to check and benchmark `lndecode` against.
+    """
     hrp, data = bech32_decode(a)
     if not hrp:
         raise ValueError("Bad bech32 checksum")
@@ -365,3 +481,384 @@ def lndecode(a):
             bytearray([ord(c) for c in hrp]) + data.tobytes(), addr.signature)
 
     return addr
+
+
+# Binary representation of every 5-bit value, joining these and parsing
+# the result with int() is much faster than shifting in words one by one.
+U5_BITS = ['{:05b}'.format(i) for i in range(32)]
+
+def u5_to_int(words):
+    if not words:
+        return 0
+    return int(''.join([U5_BITS[w] for w in words]), 2)
+
+def u5_to_bytes(words, pad=False):
+    """ Convert 5-bit words to bytes
+
+    Trailing bits that don't fill a byte are discarded, like
+    `trim_to_bytes`, or zero-padded to a full byte if `pad` is set, like
+    `BitArray.tobytes`.
+    """
+    nbits = len(words) * 5
+    value = u5_to_int(words)
+    if pad:
+        extra = -nbits % 8
+        return (value << extra).to_bytes((nbits + extra) // 8, 'big')
+    extra = nbits % 8
+    return (value >> extra).to_bytes(nbits // 8, 'big')
+
+def u5_to_bitstream(words):
+    return bitstring.ConstBitStream(bin=''.join([U5_BITS[w] for w in words]))
+
+def parse_fallback_u5(words, currency):
+    if currency == 'bc' or currency == 'tb':
+        wver = words[0]
+        if wver == 17:
+            addr=base58.b58encode_check(bytes([base58_prefix_map[currency][0]])
+                                        + u5_to_bytes(words[1:], pad=True))
+        elif wver == 18:
+            addr=base58.b58encode_check(bytes([base58_prefix_map[currency][1]])
+                                        + u5_to_bytes(words[1:], pad=True))
+        elif wver <= 16:
+            addr=bech32_encode(currency, words)
+        else:
+            return None
+    else:
+        addr=u5_to_bytes(words, pad=True)
+    return addr
+
+def int_to_u5(value, num_words):
+    """ Big-endian 5-bit words of the lowest `num_words * 5` bits of value
+    """
+    return [(value >> (5 * i)) & 31 for i in range(num_words - 1, -1, -1)]
+
+def bytes_to_u5(b):
+    """ Convert bytes to 5-bit words, zero-padding the last word
+    """
+    nbits = len(b) * 8
+    extra = -nbits % 5
+    return int_to_u5(int.from_bytes(b, 'big') << extra, (nbits + extra) // 5)
+
+def encode_fallback_u5(fallback, currency):
+    """ Encode all supported fallback addresses as 5-bit words.
+    """
+    if currency == 'bc' or currency == 'tb':
+        fbhrp, witness = bech32_decode(fallback)
+        if fbhrp:
+            if fbhrp != currency:
+                raise ValueError("Not a bech32 address for this currency")
+            if witness[0] > 16:
+                raise ValueError("Invalid witness version {}".format(witness[0]))
+            return witness
+        addr = base58.b58decode_check(fallback)
+        if is_p2pkh(currency, addr[0]):
+            wver = 17
+        elif is_p2sh(currency, addr[0]):
+            wver = 18
+        else:
+            raise ValueError("Unknown address type for {}".format(currency))
+        return [wver] + bytes_to_u5(addr[1:])
+    else:
+        raise NotImplementedError("Support for currency {} not implemented".format(currency))
+
+def tagged_u5(char, words):
+    if len(words) >= 1024:
+        raise ValueError("Tagged field '{}' is too long".format(char))
+    return [CHARSET.find(char), len(words) // 32, len(words) % 32] + words
+
+def lnencode(addr, privkey):
+    """ Encode and sign a BOLT11 invoice
+
+    Builds the list of 5-bit words directly instead of concatenating
+    bitstrings, producing the same invoice as `lnencode_bitstring`.
+    """
+    if addr.amount:
+        amount = Decimal(str(addr.amount))
+        # We can only send down to millisatoshi.
+        if amount * 10**12 % 10:
+            raise ValueError("Cannot encode {}: too many decimal places".format(
+                addr.amount))
+
+        amount = addr.currency + shorten_amount(amount)
+    else:
+        amount = addr.currency if addr.currency else ''
+
+    hrp = 'ln' + amount
+
+    # Start with the timestamp
+    data = int_to_u5(addr.date, 7)
+
+    # Payment hash
+    data += tagged_u5('p', bytes_to_u5(addr.paymenthash))
+    tags_set = set()
+
+    for k, v in addr.tags:
+
+        # BOLT #11:
+        #
+        # A writer MUST NOT include more than one `d`, `h`, `n` or `x` fields,
+        if k in ('d', 'h', 'n', 'x'):
+            if k in tags_set:
+                raise ValueError("Duplicate '{}' tag".format(k))
+
+        if k == 'r':
+            pubkey, channel, fee, cltv = v
+            route = (bytes(pubkey) + bytes(channel) +
+                     fee.to_bytes(8, 'big', signed=True) +
+                     cltv.to_bytes(2, 'big', signed=True))
+            data += tagged_u5('r', bytes_to_u5(route))
+        elif k == 'f':
+            data += tagged_u5('f', encode_fallback_u5(v, addr.currency))
+        elif k == 'd':
+            data += tagged_u5('d', bytes_to_u5(v.encode()))
+        elif k == 'x':
+            # Get minimal length by trimming leading 5 bits at a time.
+            expiry = int_to_u5(v, 12)
+            while expiry and expiry[0] == 0:
+                expiry = expiry[1:]
+            data += tagged_u5('x', expiry)
+        elif k == 'h':
+            # lndecode returns the hash itself, accept it to re-encode
+            if not isinstance(v, bytes):
+                v = hashlib.sha256(v.encode('utf-8')).digest()
+            data += tagged_u5('h', bytes_to_u5(v))
+        elif k == 'n':
+            data += tagged_u5('n', bytes_to_u5(v))
+        else:
+            # FIXME: Support unknown tags?
+            raise ValueError("Unknown tag {}".format(k))
+
+        tags_set.add(k)
+
+    # BOLT #11:
+    #
+    # A writer MUST include either a `d` or `h` field, and MUST NOT include
+    # both.
+    if 'd' in tags_set and 'h' in tags_set:
+        raise ValueError("Cannot include both 'd' and 'h'")
+    if not 'd' in tags_set and not 'h' in tags_set:
+        raise ValueError("Must include either 'd' or 'h'")
+
+    # We actually sign the hrp, then data (padded to 8 bits with zeroes).
+    privkey = secp256k1.PrivateKey(bytes(unhexlify(privkey)))
+    sig = privkey.ecdsa_sign_recoverable(hrp.encode('ascii') + u5_to_bytes(data, pad=True))
+    # This doesn't actually serialize, but returns a pair of values :(
+    sig, recid = privkey.ecdsa_recoverable_serialize(sig)
+
+    # The 65 signature bytes are exactly 104 words, no padding needed.
+    data += bytes_to_u5(bytes(sig) + bytes([recid]))
+
+    return bech32_encode(hrp, data)
+
+def lndecode(a):
+    """ Decode a BOLT11 invoice
+
+    Works directly on the list of 5-bit words returned by bech32_decode,
+    only converting the fields we actually interpret to integers or
+    bytes. Tagged fields and the signature are only split off here and
+    interpreted by the returned LnAddr on first use. The result is
+    otherwise the same as that of `lndecode_bitstring`.
+    """
+    hrp, data = bech32_decode(a)
+    if not hrp:
+        raise ValueError("Bad bech32 checksum")
+
+    # BOLT #11:
+    #
+    # A reader MUST fail if it does not understand the `prefix`.
+    if not hrp.startswith('ln'):
+        raise ValueError("Does not start with ln")
+
+    # Final signature 65 bytes (104 words), split it off.
+    if len(data) * 5 < 65*8:
+        raise ValueError("Too short to contain signature")
+    sigdecoded = u5_to_bytes(data[-104:])
+    data = data[:-104]
+
+    addr = LnAddr()
+
+    m = re.search("[^\d]+", hrp[2:])
+    if m:
+        addr.currency = m.group(0)
+        amountstr = hrp[2+m.end():]
+        # BOLT #11:
+        #
+        # A reader SHOULD indicate if amount is unspecified, otherwise it MUST
+        # multiply `amount` by the `multiplier` value (if any) to derive the
+        # amount required for payment.
+        if amountstr != '':
+            addr.amount = unshorten_amount(amountstr)
+
+    addr.date = u5_to_int(data[:7])
+    addr._fields = split_tagged_fields(data)
+    addr._raw = (hrp, data, sigdecoded)
+    return addr
+
+def split_tagged_fields(data):
+    """ Split the words following the timestamp into (tag, words) pairs
+    """
+    fields = []
+    pos = 7
+    while pos != len(data):
+        if pos + 3 > len(data):
+            raise ValueError("Truncated tagged field")
+        data_length = data[pos + 1] * 32 + data[pos + 2]
+        tagdata = data[pos + 3:pos + 3 + data_length]
+        if len(tagdata) != data_length:
+            raise ValueError("Truncated tagged field")
+        fields.append((CHARSET[data[pos]], tagdata))
+        pos += 3 + data_length
+    return fields
+
+def parse_tagged_fields(addr, fields):
+    """ Fill in the attributes of `addr` backed by tagged fields
+    """
+    for tag, tagdata in fields:
+        data_length = len(tagdata)
+
+        # BOLT #11:
+        #
+        # A reader MUST skip over unknown fields, an `f` field with unknown
+        # `version`, or a `p`, `h`, `n` or `r` field which does not have
+        # `data_length` 52, 52, 53 or 82 respectively.
+        if tag == 'r':
+            if data_length != 82:
+                addr._unknown_tags.append((tag, u5_to_bitstream(tagdata)))
+                continue
+
+            tagbytes = u5_to_bytes(tagdata)
+
+            addr._tags.append(('r',(
+                tagbytes[0:33],
+                tagbytes[33:41],
+                int.from_bytes(tagbytes[41:49], 'big', signed=True),
+                int.from_bytes(tagbytes[49:51], 'big', signed=True)
+            )))
+        elif tag == 'f':
+            fallback = parse_fallback_u5(tagdata, addr.currency)
+            if fallback:
+                addr._tags.append(('f', fallback))
+            else:
+                # Incorrect version.
+                addr._unknown_tags.append((tag, u5_to_bitstream(tagdata)))
+                continue
+
+        elif tag == 'd':
+            addr._tags.append(('d', u5_to_bytes(tagdata).decode('utf-8')))
+
+        elif tag == 'h':
+            if data_length != 52:
+                addr._unknown_tags.append((tag, u5_to_bitstream(tagdata)))
+                continue
+            addr._tags.append(('h', u5_to_bytes(tagdata)))
+
+        elif tag == 'x':
+            addr._tags.append(('x', u5_to_int(tagdata)))
+
+        elif tag == 'p':
+            if data_length != 52:
+                addr._unknown_tags.append((tag, u5_to_bitstream(tagdata)))
+                continue
+            addr._paymenthash = u5_to_bytes(tagdata)
+
+        elif tag == 'n':
+            if data_length != 53:
+                addr._unknown_tags.append((tag, u5_to_bitstream(tagdata)))
+                continue
+            addr._pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
+            addr._pubkey.deserialize(u5_to_bytes(tagdata))
+
+        elif tag == 'c':
+            addr._min_final_cltv_expiry = u5_to_int(tagdata)
+        else:
+            addr._unknown_tags.append((tag, u5_to_bitstream(tagdata)))
+
+def check_signature(addr, hrp, data, sigdecoded):
+    """ Verify the signature, or recover the pubkey from it
+    """
+    # We sign the hrp, then data (padded to 8 bits with zeroes).
+    msg = hrp.encode('ascii') + u5_to_bytes(data, pad=True)
+
+    # BOLT #11:
+    #
+    # A reader MUST check that the `signature` is valid (see the `n` tagged
+    # field specified below).
+    if addr._pubkey: # Specified by `n`
+        # BOLT #11:
+        #
+        # A reader MUST use the `n` field to validate the signature instead of
+        # performing signature recovery if a valid `n` field is provided.
+        addr._signature = addr._pubkey.ecdsa_deserialize_compact(sigdecoded[0:64])
+        if not addr._pubkey.ecdsa_verify(msg, addr._signature):
+            raise ValueError('Invalid signature')
+    else: # Recover pubkey from signature.
+        addr._pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
+        addr._signature = addr._pubkey.ecdsa_recoverable_deserialize(
+            sigdecoded[0:64], sigdecoded[64])
+        addr._pubkey.public_key = addr._pubkey.ecdsa_recover(msg, addr._signature)
+
+
+LNDECODE_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=LNDECODE_CACHE_SIZE)
+def lndecode_cached(a):
+    """ `lndecode` remembering the last LNDECODE_CACHE_SIZE invoices
+
+    The same LnAddr is returned to every caller, hence it is frozen.
+    Invalid invoices are not cached and raise every time. Use
+    `lndecode_cached.cache_info()` for hit statistics and
+    `lndecode_cached.cache_clear()` to empty the cache.
+    """
+    return FrozenLnAddr(lndecode(a))
+
+
+RECOVERABLE_SIGNATURE = secp256k1.ffi.typeof('secp256k1_ecdsa_recoverable_signature *')
+
+
+def lndecode_portable(a):
+    """ Decode an invoice into an LnAddr that can be pickled
+
+    secp256k1 keys and signatures are C objects that can't cross a
+    process boundary, so `pubkey` is returned serialized and `signature`
+    as a `(compact signature, recid)` pair, recid being None if the
+    signature was checked against an `n` field.
+    """
+    addr = lndecode(a)
+    if secp256k1.ffi.typeof(addr.signature) is RECOVERABLE_SIGNATURE:
+        sig = addr.pubkey.ecdsa_recoverable_serialize(addr.signature)
+    else:
+        sig = (addr.pubkey.ecdsa_serialize_compact(addr.signature), None)
+    addr.pubkey = addr.pubkey.serialize()
+    addr.signature = sig
+    return addr
+
+def restore_portable(addr):
+    """ Turn the result of `lndecode_portable` back into a regular LnAddr
+    """
+    pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
+    pubkey.deserialize(addr.pubkey)
+    sig, recid = addr.signature
+    if recid is None:
+        addr.signature = pubkey.ecdsa_deserialize_compact(sig)
+    else:
+        addr.signature = pubkey.ecdsa_recoverable_deserialize(sig, recid)
+    addr.pubkey = pubkey
+    return addr
+
+def lndecode_many(invoices, workers=None, chunksize=64):
+    """ Decode a batch of invoices on a pool of `workers` processes
+
+    The whole decode, signature recovery included, runs in the workers
+    and only the cheap deserialization of the key and signature happens
+    here. Results are in the order of `invoices`; like `lndecode` this
+    raises on the first invalid invoice. `workers=1` decodes in this
+    process, `None` uses one worker per core.
+    """
+    invoices = list(invoices)
+    if workers == 1 or len(invoices) <= chunksize:
+        return [lndecode(a) for a in invoices]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return [restore_portable(addr) for addr in
+                pool.map(lndecode_portable, invoices, chunksize=chunksize)]
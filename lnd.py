@@ -1,15 +1,17 @@
 from binascii import hexlify
 from lnaddr import lndecode
-from utils import TailableProc, BITCOIND_CONFIG
+from utils import TailableProc, BITCOIND_CONFIG, at_loop_close
+from waits import polling, sleep
 import rpc_pb2_grpc as lnrpc_grpc
 import rpc_pb2 as lnrpc
 from ephemeral_port_reserve import reserve
 
 
+import asyncio
 import grpc
+import grpc.aio
 import logging
 import os
-import time
 import codecs
 
 
@@ -49,10 +51,11 @@ class LndD(TailableProc):
             '--hodl.exit-settle',
         ]
 
-    def make_channel(self):
+    def make_channel(self, aio=False):
         with open(self.lightning_dir + '/tls.cert', 'rb') as f:
             cred = grpc.ssl_channel_credentials(f.read())
-        return grpc.secure_channel('localhost:{}'.format(self.rpc_port), cred)
+        secure_channel = grpc.aio.secure_channel if aio else grpc.secure_channel
+        return secure_channel('localhost:{}'.format(self.rpc_port), cred)
 
     def start(self):
         super().start()
@@ -61,14 +64,14 @@ class LndD(TailableProc):
         seed = self.unlocker_stub.GenSeed(lnrpc.GenSeedRequest())
         self.unlocker_stub.InitWallet(lnrpc.InitWalletRequest(wallet_password=b"password", recovery_window=0, cipher_seed_mnemonic=seed.cipher_seed_mnemonic))
         self.wait_for_log('Done catching up block hashes')
-        time.sleep(5)
+        sleep(5)
         # need to remake the channel, otherwise the Lightning gRPC service might not be there yet
         self.stub = lnrpc_grpc.LightningStub(self.make_channel())
         logging.info('LND started (pid: {})'.format(self.proc.pid))
 
     def stop(self):
         self.proc.terminate()
-        time.sleep(3)
+        sleep(3)
         if self.proc.poll() is None:
             self.proc.kill()
             self.proc.wait()
@@ -85,6 +88,7 @@ class LndNode(object):
         self.daemon = LndD(lightning_dir, bitcoind, port=lightning_port)
         self.rpc = self.daemon
         self.logger = logging.getLogger('lnd-node({})'.format(lightning_port))
+        self.aio = AsyncLndNode(self)
         self.myid = None
         self.node_id = node_id
 
@@ -133,9 +137,16 @@ class LndNode(object):
         self.logger.debug("Channel {} -> {} state: {}".format(self.id(), remote.id(), channel))
         return channel.active
 
-    def addfunds(self, bitcoind, satoshis):
+    def getaddress(self):
         req = lnrpc.NewAddressRequest(type=1)
-        addr = self.daemon.stub.NewAddress(req).address
+        return self.daemon.stub.NewAddress(req).address
+
+    def has_funds(self, satoshis):
+        balance = self.daemon.stub.WalletBalance(lnrpc.WalletBalanceRequest())
+        return balance.confirmed_balance >= satoshis
+
+    def addfunds(self, bitcoind, satoshis):
+        addr = self.getaddress()
         bitcoind.rpc.sendtoaddress(addr, float(satoshis) / 10**8)
         self.daemon.wait_for_log("Inserting unconfirmed transaction")
         bitcoind.rpc.generate(1)
@@ -144,9 +155,10 @@ class LndNode(object):
         # The above still doesn't mean the wallet balance is updated,
         # so let it settle a bit
         i = 0
-        while self.daemon.stub.WalletBalance(lnrpc.WalletBalanceRequest()).total_balance == satoshis and i < 30:
-            time.sleep(1)
-            i += 1
+        with polling():
+            while self.daemon.stub.WalletBalance(lnrpc.WalletBalanceRequest()).total_balance == satoshis and i < 30:
+                sleep(1)
+                i += 1
         assert(self.daemon.stub.WalletBalance(lnrpc.WalletBalanceRequest()).total_balance == satoshis)
 
     def openchannel(self, node_id, host, port, satoshis):
@@ -162,7 +174,7 @@ class LndNode(object):
         ))
 
         # Somehow broadcasting a tx is slow from time to time
-        time.sleep(5)
+        sleep(5)
 
     def getchannels(self):
         req = lnrpc.ChannelGraphRequest()
@@ -210,7 +222,7 @@ class LndNode(object):
 
     def restart(self):
         self.daemon.stop()
-        time.sleep(5)
+        sleep(5)
         self.daemon.start()
         self.rpc = LndRpc(self.daemon.rpc_port)
 
@@ -218,8 +230,57 @@ class LndNode(object):
         try:
             req = lnrpc.QueryRoutesRequest(pub_key=node_id, amt=int(amount/1000), num_routes=1)
             r = self.rpc.stub.QueryRoutes(req)
-        except grpc._channel._Rendezvous as e:
+        except grpc.RpcError as e:
             if (str(e).find("unable to find a path to destination") > 0):
                 return False
             raise
         return True
+
+
+class AsyncLndNode(object):
+    """The asyncio interface of an LndNode, using grpc.aio.
+
+    grpc.aio channels are bound to the event loop they were created on,
+    so we open a new one whenever we are called from a different loop,
+    and close it along with its loop.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.loop = None
+        self.channel = None
+        self.stub = None
+
+    async def get_stub(self):
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            await self.close()
+            self.channel = self.node.daemon.make_channel(aio=True)
+            self.stub = lnrpc_grpc.LightningStub(self.channel)
+            self.loop = loop
+            at_loop_close(self.close)
+        return self.stub
+
+    async def info(self):
+        r = await (await self.get_stub()).GetInfo(lnrpc.GetInfoRequest())
+        return {
+            'id': r.identity_pubkey,
+            'blockheight': r.block_height,
+        }
+
+    async def invoice(self, amount):
+        req = lnrpc.Invoice(value=int(amount/1000))
+        rep = await (await self.get_stub()).AddInvoice(req)
+        return rep.payment_request
+
+    async def send(self, bolt11):
+        req = lnrpc.SendRequest(payment_request=bolt11)
+        res = await (await self.get_stub()).SendPaymentSync(req)
+        if res.payment_error:
+            raise ValueError(res.payment_error)
+        return hexlify(res.payment_preimage)
+
+    async def close(self):
+        if self.channel is not None:
+            await self.channel.close()
+            self.loop = self.channel = self.stub = None
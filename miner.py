@@ -0,0 +1,103 @@
+""" Mempool-aware block generation
+
+Rather than mining a block every few seconds until something happens,
+the `Miner` listens to bitcoind's `rawtx` ZMQ notifications and mines
+exactly when the transactions a test is waiting for are in the mempool.
+"""
+from bitcoin.core import CTransaction, b2lx
+
+import logging
+import threading
+import time
+import zmq
+
+
+class Miner(object):
+
+    def __init__(self, bitcoind):
+        self.bitcoind = bitcoind
+        self.seen = set()
+        self.cond = threading.Condition()
+        self.running = False
+        self.logger = logging.getLogger('miner')
+
+    def start(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'rawtx')
+        self.socket.connect('tcp://127.0.0.1:{}'.format(self.bitcoind.zmqpubrawtx_port))
+        self.running = True
+        self.thread = threading.Thread(target=self.listen)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+        self.context.term()
+
+    def listen(self):
+        """Remember the txid of every transaction bitcoind announces.
+        """
+        while self.running:
+            if not self.socket.poll(500):
+                continue
+            topic, body = self.socket.recv_multipart()[:2]
+            txid = b2lx(CTransaction.deserialize(body).GetTxid())
+            self.logger.debug("Saw transaction {}".format(txid))
+            with self.cond:
+                self.seen.add(txid)
+                self.cond.notify_all()
+
+    def wait_for_mempool(self, txids=None, count=1, timeout=60):
+        """Block until all `txids` are in the mempool.
+
+        Without `txids` wait for the mempool to hold at least `count`
+        transactions. ZMQ may drop notifications sent before the
+        subscription was established, so we also fall back to asking
+        bitcoind once per second.
+        """
+        deadline = time.time() + timeout
+        missing = set(txids) if txids else set()
+        while True:
+            with self.cond:
+                missing -= self.seen
+                if txids and not missing:
+                    return
+                self.cond.wait(1)
+                missing -= self.seen
+
+            mempool = self.bitcoind.rpc.getrawmempool()
+            missing -= set(mempool)
+            if txids and not missing:
+                return
+            elif not txids and len(mempool) >= count:
+                return
+            elif time.time() > deadline:
+                raise TimeoutError("Transactions {} did not reach the mempool".format(
+                    missing if txids else count))
+
+    def confirm(self, txids, blocks=1, timeout=60):
+        """Mine `blocks` blocks as soon as all `txids` are in the mempool.
+
+        Returns the hashes of the new blocks.
+        """
+        self.wait_for_mempool(txids, timeout=timeout)
+        hashes = self.bitcoind.rpc.generate(blocks)
+        included = self.bitcoind.rpc.getblock(hashes[0])['tx']
+        if not all(txid in included for txid in txids):
+            raise ValueError("Transactions {} are not in block {}".format(txids, hashes[0]))
+        return hashes
+
+    def confirm_mempool(self, count=1, blocks=1, timeout=60):
+        """Mine `blocks` blocks once the mempool has `count` transactions.
+        """
+        self.wait_for_mempool(count=count, timeout=timeout)
+        return self.bitcoind.rpc.generate(blocks)
+
+    def mine_to_height(self, height):
+        """Mine just enough blocks to reach `height`.
+        """
+        blocks = height - self.bitcoind.rpc.getblockcount()
+        return self.bitcoind.rpc.generate(blocks) if blocks > 0 else []
@@ -0,0 +1,78 @@
+""" Statistics for spotting slower tests across runs
+
+Test durations in this suite are noisy: they depend on block times, on
+gossip timers, and on whatever else the machine was doing. A single slow
+run of a test is no reason to worry. Two checks have to hold before
+`cli.py perf` calls something a slowdown:
+
+ - per configuration, the latest duration is far outside the spread of
+   its history, measured as a robust z-score (median and median absolute
+   deviation, so earlier outliers don't hide new ones), and
+ - per test, across all its configurations, the latest run is slower than
+   the one before significantly more often than it is faster (a one-sided
+   sign test), and by a relevant margin.
+"""
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
+
+
+def mad(values):
+    """ Median absolute deviation from the median
+    """
+    m = median(values)
+    return median([abs(v - m) for v in values])
+
+
+def robust_z(value, history):
+    """ How many (robust) standard deviations `value` is above `history`
+
+    The MAD is floored at 1% of the median, identical durations would
+    otherwise make any change infinitely significant.
+    """
+    m = median(history)
+    spread = max(mad(history), 0.01 * m)
+    if spread == 0:
+        return 0.0
+    # 0.6745 makes the MAD consistent with the standard deviation of a normal distribution
+    return 0.6745 * (value - m) / spread
+
+
+def sign_test(slower, faster):
+    """ One-sided p-value of seeing `slower` or more slowdowns by chance
+
+    Ties are left out by the caller, under the null hypothesis each
+    remaining pair is slower or faster with probability 1/2.
+    """
+    n = slower + faster
+    p, coeff = 0.0, 1
+    for k in range(n + 1):
+        if k >= slower:
+            p += coeff
+        coeff = coeff * (n - k) // (k + 1)
+    return p / 2 ** n
+
+
+def compare_runs(previous, latest):
+    """ Compare two runs of a test, both {config: seconds}
+
+    Returns the number of configurations present in both, how many got
+    slower and faster, the median ratio latest/previous and the sign test
+    p-value.
+    """
+    configs = sorted(set(previous) & set(latest))
+    ratios = [latest[c] / previous[c] for c in configs if previous[c] > 0]
+    slower = sum(r > 1 for r in ratios)
+    faster = sum(r < 1 for r in ratios)
+    return {
+        'configs': len(ratios),
+        'slower': slower,
+        'faster': faster,
+        'ratio': median(ratios) if ratios else 1.0,
+        'p': sign_test(slower, faster),
+    }
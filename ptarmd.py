@@ -1,13 +1,18 @@
-from utils import TailableProc
+from binascii import unhexlify
+from hashlib import sha256
+from lnaddr import lndecode_cached
+from utils import TailableProc, stream_rpc
+from waits import sleep
 
+import asyncio
 import json
 import logging
 import os
-import time
 import subprocess
 import re
 import sys
 import socket
+import threading
 
 
 class PtarmD(TailableProc):
@@ -32,7 +37,7 @@ class PtarmD(TailableProc):
     def start(self):
         TailableProc.start(self)
         self.wait_for_log("start bitcoin testnet/regtest", offset=100)
-        time.sleep(3)
+        sleep(3)
         logging.info("PtarmD started")
 
     def stop(self):
@@ -49,12 +54,16 @@ class PtarmNode(object):
         self.executor = executor
         self.daemon = PtarmD(lightning_dir, btc.bitcoin_dir, port=lightning_port)
         self.rpc = PtarmRpc('127.0.0.1', lightning_port+1234)
+        self.aio = AsyncPtarmNode(self.rpc, self.daemon)
         self.logger = logging.getLogger('ptarm-node({})'.format(lightning_port))
         self.myid = None
         self.node_id = node_id
         self.bitcoind = None
-        self.txid = None
-        self.vout = None
+        # ptarmd funds each channel from an outpoint we pass it, track
+        # one per address handed out and use them in order
+        self.addrs = []
+        self.outpoints = []
+        self.lock = threading.Lock()
         self.peer_host = None
         self.peer_port = None
         self.peer_node_id = None
@@ -77,23 +86,50 @@ class PtarmNode(object):
         # Make sure we have a connection already
         if node_id not in self.peers():
             raise ValueError("Must connect to node before opening a channel")
-        return self.rpc.fundchannel(node_id, self.peer_host, self.peer_port, self.txid, self.vout, satoshis, self.push_sat, self.feerate_per_kw)
+        with self.lock:
+            if not self.outpoints:
+                raise ValueError("No funded outpoint left to open a channel from")
+            txid, vout = self.outpoints.pop(0)
+        return self.rpc.fundchannel(node_id, self.peer_host, self.peer_port, txid, vout, satoshis, self.push_sat, self.feerate_per_kw)
 
     def getaddress(self):
-        raise NotImplementedError()
+        # ptarmd uses bitcoind's wallet.
+        self.bitcoind = self.bitcoin
+        addr = self.bitcoind.rpc.getnewaddress('', 'p2sh-segwit')
+        self.addrs.append(addr)
+        return addr
+
+    def has_funds(self, satoshis):
+        while self.addrs:
+            unspent = self.bitcoind.rpc.listunspent(0, 9999999, [self.addrs[0]])
+            if not unspent:
+                return False
+            self.add_outpoint(unspent[0]['txid'], unspent[0]['vout'])
+            self.addrs.pop(0)
+
+        total = 0
+        for txid, vout in self.outpoints:
+            txout = self.bitcoind.rpc.gettxout(txid, vout)
+            if txout['confirmations'] == 0:
+                return False
+            total += txout['value'] * 10**8
+        return total >= satoshis
+
+    def add_outpoint(self, txid, vout):
+        # Lock vout to not be used for other transactions.
+        assert self.bitcoind.rpc.lockunspent(False, [{"txid": txid, "vout":  vout}])
+        with self.lock:
+            self.outpoints.append((txid, vout))
 
     def addfunds(self, bitcoind, satoshis):
         # ptarmd uses bitcoind's wallet.
         self.bitcoind = bitcoind
         addr = bitcoind.rpc.getnewaddress('', 'p2sh-segwit')
-        self.txid = bitcoind.rpc.sendtoaddress(addr, float(satoshis) / 10**8)
+        txid = bitcoind.rpc.sendtoaddress(addr, float(satoshis) / 10**8)
         listunspent = bitcoind.rpc.listunspent(0, 1, [addr])
-        self.vout = listunspent[0]['vout']
+        self.add_outpoint(txid, listunspent[0]['vout'])
 
-        # Lock vout to not be used for other transactions.
-        assert bitcoind.rpc.lockunspent(False, [{"txid": self.txid, "vout":  self.vout}])
-
-        time.sleep(1)
+        sleep(1)
         bitcoind.rpc.generate(1)
 
     def ping(self):
@@ -201,13 +237,13 @@ class PtarmNode(object):
         }
 
     def block_sync(self, blockhash):
-        time.sleep(1)
+        sleep(1)
 
     def restart(self):
         self.daemon.stop()
-        time.sleep(5)
+        sleep(5)
         self.daemon.start()
-        time.sleep(1)
+        sleep(1)
 
     def check_route(self, node_id, amount):
         proc = subprocess.run(['{}/bin/routing'.format(os.getcwd()), '-s', self.id(), '-r', node_id, '-a', str(amount)], \
@@ -289,6 +325,31 @@ class TcpSocketRpc(object):
             raise ValueError("Malformed response, \"result\" missing.")
         return resp["result"]
 
+    async def call_async(self, method, payload=None):
+        """`call` on an asyncio TCP connection.
+        """
+        self.logger.debug("Calling %s with payload %r", method, payload)
+
+        if payload is None:
+            payload = {}
+        # Filter out arguments that are None
+        payload = [v for v in payload if v is not None]
+
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        resp, _ = await stream_rpc(reader, writer, method, payload)
+
+        self.logger.debug("Received response for %s call: %r", method, resp)
+        if "error" in resp:
+            raise ValueError(
+                "RPC call failed: {}, method: {}, payload: {}".format(
+                    resp["error"],
+                    method,
+                    payload
+                ))
+        elif "result" not in resp:
+            raise ValueError("Malformed response, \"result\" missing.")
+        return resp["result"]
+
 
 class PtarmRpc(TcpSocketRpc):
 
@@ -311,3 +372,39 @@ class PtarmRpc(TcpSocketRpc):
         payload = [peer_id, peer_host, peer_port, txid, txindex, funding_sat, push_sat, feerate_per_kw]
         return self.call("fund", payload)
 
+
+
+class AsyncPtarmNode(object):
+    """The asyncio interface of a PtarmNode, over asyncio TCP connections.
+    """
+
+    def __init__(self, rpc, daemon):
+        self.rpc = rpc
+        self.daemon = daemon
+
+    async def info(self):
+        r = await self.rpc.call_async("getinfo")
+        return {
+            'id': r['node_id'],
+            'blockheight': r['block_count'],
+        }
+
+    async def invoice(self, amount):
+        r = await self.rpc.call_async("invoice", [amount])
+        return r['bolt11']
+
+    async def send(self, req):
+        if await self.rpc.call_async("routepay", [req, 0]) != 'start payment':
+            return ''
+        # Other payments may be under way, wait for the preimage of this one
+        payment_hash = lndecode_cached(req).paymenthash
+
+        def pays(line):
+            pp = re.search('[0-9a-f]{64}', line)
+            return pp is not None and sha256(unhexlify(pp.group())).digest() == payment_hash
+
+        line = await self.daemon.wait_for_log_async("p_payment_preimage:", offset=100, match=pays)
+        return re.search('[0-9a-f]{64}', line).group()
+
+    async def close(self):
+        pass
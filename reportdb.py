@@ -0,0 +1,226 @@
+""" SQLite index of the test reports
+
+Answering questions about the report history from reports/*.json means
+parsing every report. `postprocess` therefore also records each run, the
+versions it tested, and the outcome, durations and reruns of every test
+in a SQLite database, which `cli.py reindex` can rebuild from reports/.
+"""
+import sqlite3
+import sys
+
+
+REPORT_DB = 'reports.db'
+
+# Bumped whenever a table changes, outdated tables are dropped on connect
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    duration REAL,
+    num_tests INTEGER,
+    passed INTEGER,
+    reruns INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_created_at ON runs (created_at);
+
+CREATE TABLE IF NOT EXISTS versions (
+    run_id TEXT NOT NULL REFERENCES runs (id),
+    implementation TEXT NOT NULL,
+    version TEXT NOT NULL,
+    PRIMARY KEY (run_id, implementation)
+);
+
+-- One row per test, pytest-json merges all attempts of a test into a single
+-- entry. Outcome and phase durations are those of the final attempt,
+-- rerun_duration is the time spent in the attempts before it
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT NOT NULL REFERENCES runs (id),
+    test TEXT NOT NULL,
+    config TEXT NOT NULL,
+    run_index INTEGER NOT NULL,
+    outcome TEXT,
+    duration REAL,
+    setup_duration REAL,
+    call_duration REAL,
+    teardown_duration REAL,
+    attempts INTEGER,
+    rerun_duration REAL,
+    PRIMARY KEY (run_id, test, config, run_index)
+);
+CREATE INDEX IF NOT EXISTS results_test_config ON results (test, config);
+"""
+
+
+def connect(path=REPORT_DB):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        tables = db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        if tables:
+            print("{} is outdated, run `cli.py reindex`".format(path), file=sys.stderr)
+        db.executescript("""
+            DROP TABLE IF EXISTS results;
+            DROP TABLE IF EXISTS versions;
+            DROP TABLE IF EXISTS runs;
+            PRAGMA user_version = {};
+        """.format(SCHEMA_VERSION))
+    db.executescript(SCHEMA)
+    return db
+
+
+def split_test_name(nodeid):
+    """ 'test.py::test_foo[EclairNode_LndNode]' -> ('test_foo', 'EclairNode_LndNode')
+    """
+    name = nodeid.split('::')[-1]
+    if '[' not in name:
+        return name, ''
+    name, config = name.split('[', 1)
+    return name, config[:-1]
+
+
+def phase_duration(test, phase):
+    if phase not in test or 'duration' not in test[phase]:
+        return None
+    return float(test[phase]['duration'])
+
+
+def test_reruns(test):
+    """ The number of attempts of a test entry, and the seconds spent in all but the last
+
+    Every attempt adds its metrics, including the duration of its phases,
+    to the entry's metadata, see conftest.py. Older reports only tell from
+    the entry's duration, which adds up the logged phases of all attempts
+    and the first phase once more, whether a test was rerun at all, such a
+    test counts as rerun once.
+    """
+    metadata = test.get('metadata') or []
+    if metadata and all('durations' in m for m in metadata):
+        return len(metadata), sum(sum(m['durations'].values()) for m in metadata[:-1])
+    final = sum(phase_duration(test, p) or 0.0 for p in ['setup', 'setup', 'call', 'teardown'])
+    extra = (test.get('duration') or 0.0) - final
+    # Leaves room for rounding, the entry's duration is a float sum
+    if extra > 0.001:
+        return 2, extra
+    return 1, 0.0
+
+
+def test_record(run_id, test):
+    """ The `results` row of a single test entry of a pytest-json report
+    """
+    name, config = split_test_name(test['name'])
+    attempts, rerun_duration = test_reruns(test)
+    return (
+        run_id, name, config, test.get('run_index', 0), test['outcome'],
+        test.get('duration'),
+        phase_duration(test, 'setup'),
+        phase_duration(test, 'call'),
+        phase_duration(test, 'teardown'),
+        attempts, rerun_duration,
+    )
+
+
+def add_run(db, report):
+    """ Record a run, everything but its tests, replacing earlier records
+    """
+    db.execute("DELETE FROM results WHERE run_id = ?", (report['id'],))
+    db.execute("DELETE FROM versions WHERE run_id = ?", (report['id'],))
+    db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)", (
+        report['id'], report['created_at'], report['summary'].get('duration'),
+        report['summary']['num_tests'], report['summary'].get('passed', 0),
+        report['summary'].get('rerun', 0)))
+    db.executemany("INSERT INTO versions VALUES (?, ?, ?)", [
+        (report['id'], impl, version) for impl, version in report['versions'].items()])
+
+
+def add_tests(db, run_id, tests):
+    db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (test_record(run_id, t) for t in tests))
+
+
+def config_implementations(config):
+    """ 'EclairNode_LndNode' -> ['eclair', 'lnd']
+    """
+    return [c.lower()[:-len('node')] if c.lower().endswith('node') else c.lower()
+            for c in config.split('_') if c]
+
+
+# The `last` runs created at or before a time, for
+# `query.format(run_filter, test_filter)`
+RECENT_RESULTS = """
+    WITH recent AS (
+        SELECT id, created_at FROM runs {} ORDER BY created_at DESC LIMIT ?
+    )
+    SELECT r.*, recent.created_at
+    FROM results r JOIN recent ON recent.id = r.run_id {}
+"""
+
+
+def recent_params(last, test, before):
+    run_filter = "WHERE created_at <= ?" if before else ""
+    test_filter = "WHERE r.test = ?" if test else ""
+    params = ([before] if before else []) + [last if last else -1] + ([test] if test else [])
+    return run_filter, test_filter, params
+
+
+def final_results(db, last=None, test=None, before=None):
+    """ The outcome of every test in the `last` runs
+
+    Only runs created at or before `before` are considered, if given.
+    Returns rows of (run_id, created_at, test, config, outcome,
+    attempts, duration, call_duration), newest runs first.
+    """
+    run_filter, test_filter, params = recent_params(last, test, before)
+    query = """
+        SELECT run_id, created_at, test, config, outcome, attempts, duration, call_duration
+        FROM ({})
+        ORDER BY created_at DESC, test, config
+    """.format(RECENT_RESULTS.format(run_filter, test_filter))
+    return db.execute(query, params).fetchall()
+
+
+def rerun_stats(db, last=None, test=None):
+    """ How often each test and configuration was rerun in the `last` runs
+
+    Returns rows of (test, config, runs, rerun_runs, flaky_runs,
+    failed_runs, reruns, wasted). A flaky run passed only on a rerun,
+    `wasted` is the time spent in all but the final attempts.
+    """
+    run_filter, test_filter, params = recent_params(last, test, None)
+    query = """
+        SELECT test, config, COUNT(*) AS runs,
+               SUM(attempts > 1) AS rerun_runs,
+               SUM(attempts > 1 AND outcome = 'passed') AS flaky_runs,
+               SUM(outcome != 'passed') AS failed_runs,
+               SUM(attempts - 1) AS reruns,
+               SUM(rerun_duration) AS wasted
+        FROM ({})
+        GROUP BY test, config
+        ORDER BY wasted DESC, test, config
+    """.format(RECENT_RESULTS.format(run_filter, test_filter))
+    return db.execute(query, params).fetchall()
+
+
+def run_reruns(db, last=None):
+    """ The number of reruns pytest-rerunfailures counted in each of the `last` runs
+    """
+    return db.execute("SELECT id, reruns FROM runs ORDER BY created_at DESC LIMIT ?",
+                      (last if last else -1,)).fetchall()
+
+
+def duration_history(db, last=None, test=None, before=None):
+    """ Call durations of passing tests, per (test, config), oldest first
+
+    Returns {(test, config): [(run_id, created_at, seconds), ...]}.
+    Failed attempts usually end in a timeout and would only add noise.
+    """
+    history = {}
+    for r in reversed(final_results(db, last=last, test=test, before=before)):
+        seconds = r['call_duration'] if r['call_duration'] is not None else r['duration']
+        if r['outcome'] != 'passed' or seconds is None:
+            continue
+        history.setdefault((r['test'], r['config']), []).append(
+            (r['run_id'], r['created_at'], seconds))
+    return history
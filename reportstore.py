@@ -0,0 +1,230 @@
+""" Reading and writing report files without holding them in memory
+
+The raw report.json of a full matrix run is dominated by the output each
+test captured, and can grow to hundreds of megabytes. Reports are read
+with ijson, one test at a time, and the captured output is moved into
+gzipped blobs under reports/blobs/, named after the sha256 of their
+content, leaving a `<field>_blob` reference in the test's phase. Runs
+mostly capture the same output, so blobs are shared between reports.
+Output shorter than BLOB_MIN_SIZE stays in the report, a file per line
+of RPC logging would take more space than it saves.
+
+Reports are stored gzipped as reports/<id>.json.gz, older uncompressed
+reports/<id>.json are read just as well.
+"""
+from hashlib import sha256
+
+import gzip
+import ijson
+import io
+import json
+import os
+import shutil
+
+
+REPORT_DIR = 'reports'
+BLOB_DIR = os.path.join(REPORT_DIR, 'blobs')
+
+PHASES = ['setup', 'call', 'teardown']
+OUTPUT_FIELDS = ['stdout', 'stderr']
+BLOB_MIN_SIZE = 4096
+
+SCALAR_EVENTS = ['null', 'boolean', 'integer', 'double', 'number', 'string']
+
+
+def join_path(prefix, key):
+    return prefix + '.' + key if prefix else key
+
+
+def read_header(f, prefix=''):
+    """ All fields of the object at `prefix` but its tests
+
+    Use prefix 'report' for the report.json written by pytest-json.
+    """
+    header = {}
+    key, builder = None, None
+    for path, event, value in ijson.parse(f, use_float=True):
+        if path == prefix and event == 'map_key':
+            key = value
+            builder = ijson.ObjectBuilder() if key != 'tests' else None
+            continue
+        if builder is None:
+            continue
+        builder.event(event, value)
+        if path == join_path(prefix, key) and (event in SCALAR_EVENTS or event in ['end_map', 'end_array']):
+            header[key] = builder.value
+            builder = None
+    return header
+
+
+def iter_tests(f, prefix=''):
+    return ijson.items(f, join_path(prefix, 'tests.item'), use_float=True)
+
+
+def iter_metrics(f, name, prefix=''):
+    """ The metric `name` recorded by any attempt of any test, see conftest.py
+    """
+    return ijson.items(f, join_path(prefix, 'tests.item.metadata.item.' + name), use_float=True)
+
+
+def put_blob(text, blob_dir=BLOB_DIR):
+    """ Store `text` compressed, unless we already have it, and return its hash
+    """
+    data = text.encode('UTF-8')
+    digest = sha256(data).hexdigest()
+    path = os.path.join(blob_dir, digest + '.gz')
+    if not os.path.exists(path):
+        if not os.path.exists(blob_dir):
+            os.makedirs(blob_dir)
+        with gzip.open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+    return digest
+
+
+def get_blob(digest, blob_dir=BLOB_DIR):
+    with gzip.open(os.path.join(blob_dir, digest + '.gz'), 'rb') as f:
+        return f.read().decode('UTF-8')
+
+
+def extract_output(test, blob_dir=BLOB_DIR):
+    """ Move the longer captured output of `test` into blobs
+    """
+    for phase in PHASES:
+        for field in OUTPUT_FIELDS:
+            if len(test.get(phase, {}).get(field, '')) >= BLOB_MIN_SIZE:
+                test[phase][field + '_blob'] = put_blob(test[phase].pop(field), blob_dir)
+    return test
+
+
+def drop_output(test):
+    for phase in PHASES:
+        for field in OUTPUT_FIELDS:
+            test.get(phase, {}).pop(field, None)
+    return test
+
+
+def report_files(report_dir=REPORT_DIR):
+    return sorted(f for f in os.listdir(report_dir) if f.endswith('.json') or f.endswith('.json.gz'))
+
+
+def report_path(report_id, report_dir=REPORT_DIR):
+    """ Where the report `report_id` is stored, compressed or not
+    """
+    path = os.path.join(report_dir, report_id + '.json')
+    return path if os.path.exists(path) else path + '.gz'
+
+
+def open_report(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class ReportWriter(object):
+    """ Writes a gzipped report one test at a time
+
+    The file only appears under `path` once all tests have been written.
+    The gzip header carries no timestamp, so the same report always
+    compresses to the same bytes.
+    """
+    def __init__(self, path, header):
+        self.path = path
+        self.raw = open(path + '.tmp', 'wb')
+        self.f = io.TextIOWrapper(gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, mtime=0), 'UTF-8')
+        self.f.write(json.dumps(header)[:-1] + ', "tests": [')
+        self.count = 0
+
+    def write(self, test):
+        if self.count:
+            self.f.write(', ')
+        self.f.write(json.dumps(test))
+        self.count += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.f.write(']}')
+        self.f.close()
+        self.raw.close()
+        if exc_type is not None:
+            os.remove(self.path + '.tmp')
+        else:
+            os.rename(self.path + '.tmp', self.path)
+
+
+def read_report(path):
+    """ A stored report, without the output its tests captured
+    """
+    with open_report(path) as f:
+        report = read_header(f)
+    with open_report(path) as f:
+        report['tests'] = [drop_output(t) for t in iter_tests(f)]
+    return report
+
+
+def report_blobs(path):
+    """ Hashes of all blobs the report at `path` refers to
+    """
+    digests = set()
+    with open_report(path) as f:
+        for test in iter_tests(f):
+            for phase in PHASES:
+                for field in OUTPUT_FIELDS:
+                    if field + '_blob' in test.get(phase, {}):
+                        digests.add(test[phase][field + '_blob'])
+    return digests
+
+
+class LocalBlob(object):
+    def __init__(self, path):
+        self.path = path
+        self.content_encoding = None
+
+    @property
+    def public_url(self):
+        return 'file://' + os.path.abspath(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def upload_from_filename(self, filename, content_type=None):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        shutil.copyfile(filename, self.path + '.tmp')
+        os.rename(self.path + '.tmp', self.path)
+
+
+class LocalBucket(object):
+    """ A directory standing in for a GCS bucket, to try out uploads
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def blob(self, name):
+        return LocalBlob(os.path.join(self.path, name))
+
+
+def upload_report(bucket, path):
+    """ Upload a report, and those of its blobs the bucket doesn't have yet
+
+    Blobs are named after their content, one that exists is the same.
+    Returns the report's blob and the number of blobs uploaded.
+    """
+    uploaded = 0
+    for digest in sorted(report_blobs(path)):
+        blob = bucket.blob('blobs/' + digest + '.gz')
+        if blob.exists():
+            continue
+        blob.upload_from_filename(os.path.join(BLOB_DIR, digest + '.gz'), content_type='application/gzip')
+        uploaded += 1
+
+    blob = bucket.blob(os.path.basename(path))
+    if path.endswith('.gz'):
+        # Served decompressed to clients that don't accept gzip
+        blob.content_encoding = 'gzip'
+    blob.upload_from_filename(path, content_type='application/json')
+    return blob, uploaded
@@ -1,17 +1,21 @@
 from binascii import unhexlify, hexlify
 from btcproxy import ProxiedBitcoinD
+from corpus import decoded_fields, save_corpus
 from eclair import EclairNode
 from ephemeral_port_reserve import reserve
+from gossip import GossipMonitor
 from hashlib import sha256
 from itertools import product
 from lightningd import LightningNode
-from lnaddr import lndecode
+from lnaddr import lndecode, lndecode_bitstring, lndecode_cached
 from lnd import LndNode
 from ptarmd import PtarmNode
+from topology import build_network, line, ring, star, scale_free
 from concurrent import futures
-from utils import BitcoinD, BtcD
+from utils import BitcoinD, BtcD, confirm_channels, fund_nodes, run_async, wait_for, sync_blockheight
 from bech32 import bech32_decode
 from electrumutils import ElectrumX, ElectrumNode
+from waits import sleep
 
 from fixtures import *
 
@@ -20,7 +24,6 @@ import os
 import pytest
 import sys
 import tempfile
-import time
 
 impls = [EclairNode, LightningNode, LndNode, PtarmNode, ElectrumNode]
 
@@ -41,40 +44,6 @@ def transact_and_mine(btc):
         btc.rpc.generate(1)
 
 
-def wait_for(success, timeout=30, interval=1):
-    start_time = time.time()
-    while not success() and time.time() < start_time + timeout:
-        time.sleep(interval)
-    if time.time() > start_time + timeout:
-        raise ValueError("Error waiting for {}", success)
-
-
-def sync_blockheight(btc, nodes):
-    info = btc.rpc.getblockchaininfo()
-    blocks = info['blocks']
-
-    print("Waiting for %d nodes to blockheight %d" % (len(nodes), blocks))
-    for n in nodes:
-        wait_for(lambda: n.info()['blockheight'] == blocks, interval=1)
-
-
-def generate_until(btc, success, blocks=30, interval=1):
-    """Generate new blocks until `success` returns true.
-
-    Mainly used to wait for transactions to confirm since they might
-    be delayed and we don't want to add a long waiting time to all
-    tests just because some are slow.
-    """
-    for i in range(blocks):
-        time.sleep(interval)
-        if success():
-            return
-        btc.rpc.generate(1)
-    time.sleep(interval)
-    if not success():
-        raise ValueError("Generated %d blocks, but still no success", blocks)
-
-
 def idfn(impls):
     return "_".join([i.displayName for i in impls])
 
@@ -111,17 +80,7 @@ def confirm_channel(bitcoind, n1, n2):
     print("Waiting for channel {} -> {} to confirm".format(n1.id(), n2.id()))
     assert n1.id() in n2.peers()
     assert n2.id() in n1.peers()
-    for i in range(10):
-        time.sleep(2)
-        if n1.check_channel(n2) and n2.check_channel(n1):
-            print("Channel {} -> {} confirmed".format(n1.id(), n2.id()))
-            return True
-        bhash = bitcoind.rpc.generate(1)[0]
-        n1.block_sync(bhash)
-        n2.block_sync(bhash)
-
-    # Last ditch attempt
-    return n1.check_channel(n2) and n2.check_channel(n1)
+    return confirm_channels(bitcoind, [(n1, n2)], interval=2)[0] is not None
 
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
@@ -137,7 +96,7 @@ def test_open_channel(bitcoind, node_factory, impls):
     node1.addfunds(bitcoind, 2 * 10**7)
 
     node1.openchannel(node2.id(), 'localhost', node2.daemon.port, 10**7)
-    time.sleep(1)
+    sleep(1)
     bitcoind.rpc.generate(2)
 
     assert confirm_channel(bitcoind, node1, node2)
@@ -150,7 +109,7 @@ def test_open_channel(bitcoind, node_factory, impls):
 
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
-def test_gossip(node_factory, bitcoind, impls):
+def test_gossip(node_factory, bitcoind, metrics, impls):
     """ Create a network of lightningd nodes and connect to it using 2 new nodes
     """
     # These are the nodes we really want to test
@@ -158,35 +117,36 @@ def test_gossip(node_factory, bitcoind, impls):
     node2 = node_factory.get_node(implementation=impls[1])
 
     # Using lightningd since it is quickest to start up
-    nodes = [node_factory.get_node(implementation=LightningNode) for _ in range(5)]
-    for n1, n2 in zip(nodes[:4], nodes[1:]):
-        n1.connect('localhost', n2.daemon.port, n2.id())
-        n1.addfunds(bitcoind, 2 * 10**7)
-        n1.openchannel(n2.id(), 'localhost', n2.daemon.port, 10**7)
-        assert confirm_channel(bitcoind, n1, n2)
-
-    time.sleep(5)
-    bitcoind.rpc.generate(30)
-    time.sleep(5)
+    topology = line(5)
+    nodes, announced_at = build_network(node_factory, bitcoind, topology, LightningNode)
 
     # Wait for gossip to settle
-    for n in nodes:
-        wait_for(lambda: len(n.getnodes()) == 5, interval=1, timeout=120)
-        wait_for(lambda: len(n.getchannels()) == 8, interval=1, timeout=120)
+    monitor = GossipMonitor(nodes, node_factory.executor, topology=topology.name, start_time=announced_at)
+    monitor.wait_converged(num_nodes=5, num_channels=8, timeout=120)
+    metrics['gossip'] = monitor.summary()
 
     # Now connect the first node to the line graph and the second one to the first
+    joined = GossipMonitor([node1, node2], node_factory.executor, topology=topology.name)
     node1.connect('localhost', nodes[0].daemon.port, nodes[0].id())
-    node2.connect('localhost', n1.daemon.port, n1.id())
+    node2.connect('localhost', nodes[3].daemon.port, nodes[3].id())
+
+    # They should now be syncing as well, node 2 syncs through node 1
+    # TODO(cdecker) Also wait for 8 channels when eclair exposes non-local channels as well (ACINQ/eclair/issues/126)
+    joined.wait_converged(num_nodes=5, timeout=60)
+    metrics['gossip_join'] = joined.summary()
+
 
-    # They should now be syncing as well
-    # TODO(cdecker) Uncomment the following line when eclair exposes non-local channels as well (ACINQ/eclair/issues/126)
-    #wait_for(lambda: len(node1.getchannels()) == 8)
-    wait_for(lambda: len(node1.getnodes()) == 5, interval=1)
+@pytest.mark.skipif(not TEST_SCALE, reason="Scale tests only run with TEST_SCALE=1")
+@pytest.mark.parametrize("topology", [line(50), ring(50), star(50), scale_free(100, seed=1)], ids=lambda t: t.name)
+@pytest.mark.parametrize("impl", impls, ids=idfn)
+def test_gossip_scale(node_factory, bitcoind, metrics, impl, topology):
+    """ Build a large network of a single implementation and wait for gossip
+    """
+    nodes, announced_at = build_network(node_factory, bitcoind, topology, impl)
 
-    # Node 2 syncs through node 1
-    # TODO(cdecker) Uncomment the following line when eclair exposes non-local channels as well (ACINQ/eclair/issues/126)
-    #wait_for(lambda: len(node2.getchannels()) == 8)
-    wait_for(lambda: len(node2.getnodes()) == 5, interval=1)
+    monitor = GossipMonitor(nodes, node_factory.executor, topology=topology.name, start_time=announced_at)
+    monitor.wait_converged(num_channels=2 * len(topology.edges), timeout=600)
+    metrics['gossip'] = monitor.summary()
 
 
 @pytest.mark.parametrize("impl", impls, ids=idfn)
@@ -201,7 +161,24 @@ def test_invoice_decode(node_factory, impl):
     assert hrp and data
     assert hrp.startswith('lnbcrt')
 
-def open_channel_get_invoice(bitcoind, node_factory, impls):
+
+@pytest.mark.parametrize("impl", impls, ids=idfn)
+def test_invoice_corpus(node_factory, impl):
+    """Check that we decode the invoices of `impl` like the reference decoder.
+
+    With UPDATE_CORPUS=1 the invoices are added to the stored corpus
+    that bench_codec.py checks and benchmarks the codec against.
+    """
+    node = node_factory.get_node(implementation=impl)
+    invoices = [node.invoice(amount) for amount in [1000, 123456000, 4294967000]]
+
+    for req in invoices:
+        assert decoded_fields(lndecode(req)) == decoded_fields(lndecode_bitstring(req))
+
+    if UPDATE_CORPUS:
+        save_corpus(impl.displayName, [{'kind': 'invoice', 'bolt11': i} for i in invoices])
+
+def open_channel_get_invoice(bitcoind, miner, node_factory, impls):
     node1 = node_factory.get_node(implementation=impls[0])
     node2 = node_factory.get_node(implementation=impls[1])
     capacity = 10**7
@@ -212,15 +189,12 @@ def open_channel_get_invoice(bitcoind, node_factory, impls):
     wait_for(lambda: node2.peers(), interval=1)
 
     node1.addfunds(bitcoind, 2*capacity)
-    time.sleep(5)
+    sleep(5)
     bitcoind.rpc.generate(10)
-    time.sleep(5)
+    sleep(5)
 
     txid, csv_delay_imposed_by_remote = node1.openchannel(node2.id(), 'localhost', node2.daemon.port, capacity)
-    time.sleep(1)
-    mined = bitcoind.rpc.generate(6)
-
-    assert txid in bitcoind.rpc.getblock(mined[0])['tx']
+    mined = miner.confirm([txid], blocks=6)
     print('funding tx in block', mined[0])
 
     sync_blockheight(bitcoind, [node1, node2])
@@ -229,8 +203,8 @@ def open_channel_get_invoice(bitcoind, node_factory, impls):
     return csv_delay_imposed_by_remote, capacity, node1, node2
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
-def test_redeem_htlc_funds(bitcoind, node_factory, impls):
-    csv_delay_imposed_by_remote, capacity, node1, node2 = open_channel_get_invoice(bitcoind, node_factory, impls)
+def test_redeem_htlc_funds(bitcoind, miner, node_factory, impls):
+    csv_delay_imposed_by_remote, capacity, node1, node2 = open_channel_get_invoice(bitcoind, miner, node_factory, impls)
 
     old_bal = sum(node1.wallet.get_balance())
 
@@ -250,7 +224,6 @@ def test_redeem_htlc_funds(bitcoind, node_factory, impls):
 
     gen = node1.force_close(node2)
     closing_txid = next(gen)
-    time.sleep(1)
 
     expiration = htlcs[0].expiration_height
     local_height = node1.info()['blockheight']
@@ -258,33 +231,24 @@ def test_redeem_htlc_funds(bitcoind, node_factory, impls):
 
     print(f"expiration: {expiration}, local_height: {local_height}, diff: {diff}")
 
-    block_hash = bitcoind.rpc.generate(1)[0]
-    txids = bitcoind.rpc.getblock(block_hash)['tx']
-    assert closing_txid in txids
+    miner.confirm([closing_txid])
     wait_for(lambda: max(node1.tx_heights([closing_txid]).values()) > 0)
 
-    block_hashes = bitcoind.rpc.generate(diff)
+    bitcoind.rpc.generate(diff)
     h1 = node1.get_published_e_tx()
     h2 = node1.get_published_e_tx()
     assert h1.name.startswith('our_ctx_htlc_tx')
     assert h2.name.startswith('our_ctx_htlc_tx')
-    def wait_for_txs(txs):
-        nonlocal block_hashes
-        while True:
-            txid_list = bitcoind.rpc.getblock(block_hashes[0])['tx']
-            if all(x in txid_list for x in txs):
-                break
-            block_hashes = bitcoind.rpc.generate(1)
-    wait_for_txs([h1.tx.txid(), h2.tx.txid()])
-
-    block_hashes = bitcoind.rpc.generate(csv_delay_imposed_by_remote)
+    miner.confirm([h1.tx.txid(), h2.tx.txid()])
+
+    bitcoind.rpc.generate(csv_delay_imposed_by_remote)
     published = node1.get_published_e_tx()
     if published.name.startswith('our_ctx_to_local'):
         published = node1.get_published_e_tx()
     assert published.name.startswith('second_stage')
-    wait_for_txs([published.tx.txid()])
+    miner.confirm([published.tx.txid()])
 
-    block_hashes = bitcoind.rpc.generate(101)
+    bitcoind.rpc.generate(101)
     print("second stage stage closure", next(gen))
 
     matured, unconfirmed, unmatured = node1.wallet.get_balance()
@@ -300,18 +264,36 @@ def test_redeem_htlc_funds(bitcoind, node_factory, impls):
 
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
-def test_direct_payment(bitcoind, node_factory, impls):
-    _csv_delay, capacity, node1, node2 = open_channel_get_invoice(bitcoind, node_factory, impls)
+def test_direct_payment(bitcoind, miner, node_factory, impls):
+    _csv_delay, capacity, node1, node2 = open_channel_get_invoice(bitcoind, miner, node_factory, impls)
 
     amount = capacity // 10 * 1000
-    req = node2.invoice(amount)
-    dec = lndecode(req)
+    # Have the one invoice we need ready before paying
+    invoices = node_factory.invoice_pool(node2, amount, size=1)
+    invoices.wait_full()
+    req = invoices.get()
+    dec = lndecode_cached(req)
 
     print("Decoded payment request", req, dec)
     payment_key = node1.send(req)
     assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
 
 
+@pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
+def test_concurrent_payments(bitcoind, miner, node_factory, impls):
+    """Pay a batch of invoices at once through the asyncio interface.
+    """
+    _csv_delay, capacity, node1, node2 = open_channel_get_invoice(bitcoind, miner, node_factory, impls)
+
+    amount = capacity // 100 * 1000
+    reqs = run_async(*[node2.aio.invoice(amount) for _ in range(10)])
+    payment_keys = run_async(*[node1.aio.send(req) for req in reqs])
+
+    for req, payment_key in zip(reqs, payment_keys):
+        dec = lndecode_cached(req)
+        assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
+
+
 def gossip_is_synced(nodes, num_channels):
     print("Checking %d nodes for gossip sync" % (len(nodes)))
     for i, n in enumerate(nodes):
@@ -341,18 +323,26 @@ def node_has_route(node, channels):
 
 
 @pytest.mark.parametrize("impls", product(impls, repeat=3), ids=idfn)
-def test_forwarded_payment(bitcoind, node_factory, impls):
+def test_forwarded_payment(bitcoind, node_factory, metrics, impls):
     num_nodes = len(impls)
     nodes = [node_factory.get_node(implementation=impls[i]) for i in range(3)]
     capacity = 10**7
 
     for i in range(num_nodes-1):
         nodes[i].connect('localhost', nodes[i+1].daemon.port, nodes[i+1].id())
-        nodes[i].addfunds(bitcoind, 4 * capacity)
+    fund_nodes(bitcoind, {n: 4 * capacity for n in nodes[:-1]}, executor=node_factory.executor)
 
-    for i in range(num_nodes-1):
-        nodes[i].openchannel(nodes[i+1].id(), 'localhost', nodes[i+1].daemon.port, capacity)
-        assert confirm_channel(bitcoind, nodes[i], nodes[i+1])
+    pairs = list(zip(nodes[:-1], nodes[1:]))
+    for n1, n2 in pairs:
+        n1.openchannel(n2.id(), 'localhost', n2.daemon.port, capacity)
+    times = confirm_channels(bitcoind, pairs, executor=node_factory.executor, interval=2)
+    metrics['time_to_normal'] = [[idfn(p), t] for p, t in zip(pairs, times)]
+    assert None not in times
+
+    src = nodes[0]
+    dst = nodes[len(nodes)-1]
+    amount = capacity // 10 * 1000
+    invoices = node_factory.invoice_pool(dst, amount, size=1)
 
     bitcoind.rpc.generate(6)
     sync_blockheight(bitcoind, nodes)
@@ -363,21 +353,19 @@ def test_forwarded_payment(bitcoind, node_factory, impls):
     wait_for(lambda: node_has_route(nodes[0], route), timeout=120)
     sync_blockheight(bitcoind, nodes)
 
-    src = nodes[0]
-    dst = nodes[len(nodes)-1]
-    amount = capacity // 10 * 1000
-    req = dst.invoice(amount)
+    invoices.wait_full()
+    req = invoices.get()
 
     print("Waiting for a route to be found")
     wait_for(lambda: src.check_route(dst.id(), amount), timeout=120)
 
     payment_key = src.send(req)
-    dec = lndecode(req)
+    dec = lndecode_cached(req)
     assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
 
 
 @pytest.mark.parametrize("impls", product(impls, repeat=2), ids=idfn)
-def test_reconnect(bitcoind, node_factory, impls):
+def test_reconnect(bitcoind, miner, node_factory, impls):
     node1 = node_factory.get_node(implementation=impls[0])
     node2 = node_factory.get_node(implementation=impls[1])
     capacity = 10**7
@@ -388,41 +376,39 @@ def test_reconnect(bitcoind, node_factory, impls):
     wait_for(lambda: node2.peers(), interval=1)
 
     node1.addfunds(bitcoind, 2*capacity)
-    time.sleep(5)
+    sleep(5)
     bitcoind.rpc.generate(10)
-    time.sleep(5)
+    sleep(5)
 
     node1.openchannel(node2.id(), 'localhost', node2.daemon.port, capacity)
 
-    for i in range(30):
-        node1.bitcoin.rpc.generate(1)
-        time.sleep(1)
-
-    wait_for(lambda: node1.check_channel(node2))
-    wait_for(lambda: node2.check_channel(node1))
+    # Mine the funding depth as soon as the funding tx is broadcast, and
+    # only add more blocks while the channel is not active yet
+    miner.confirm_mempool(blocks=6)
+    assert confirm_channels(bitcoind, [(node1, node2)], blocks=24)[0] is not None
     sync_blockheight(bitcoind, [node1, node2])
 
     amount = capacity // 10 * 1000
     req = node2.invoice(amount)
     payment_key = node1.send(req)
-    dec = lndecode(req)
+    dec = lndecode_cached(req)
     assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
 
     print("Sleep before restart")
-    time.sleep(5)
+    sleep(5)
 
     print("Restarting")
     node2.restart()
 
-    time.sleep(15)
+    sleep(15)
 
     wait_for(lambda: node1.check_channel(node2))
     wait_for(lambda: node2.check_channel(node1))
     sync_blockheight(bitcoind, [node1, node2])
 
-    time.sleep(15)
+    sleep(15)
 
     req = node2.invoice(amount)
     payment_key = node1.send(req)
-    dec = lndecode(req)
+    dec = lndecode_cached(req)
     assert(sha256(unhexlify(payment_key)).digest() == dec.paymenthash)
@@ -0,0 +1,99 @@
+""" Tests of what the test suite writes into report.json
+
+Run with `py.test test_report.py`, these run pytest on small test files
+using the hooks in conftest.py, and don't need any node.
+"""
+import json
+import os
+import pytest
+import reportdb
+
+pytest_plugins = 'pytester'
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SAMPLE = """
+import pytest
+
+@pytest.fixture
+def metrics(request):
+    yield request.node.metrics
+
+@pytest.fixture
+def teardown_metric(request):
+    yield
+    request.node.metrics['teardown'] = True
+
+def test_pass(metrics, teardown_metric):
+    metrics['gossip'] = {'count': 1}
+
+def test_fail(metrics):
+    metrics['gossip'] = {'count': 2}
+    assert False
+
+def test_flaky(metrics, teardown_metric, tmpdir_factory):
+    marker = tmpdir_factory.getbasetemp().join('flaky')
+    metrics['attempt'] = 2 if marker.check() else 1
+    if not marker.check():
+        marker.write('')
+        assert False
+"""
+
+
+@pytest.fixture
+def run_report(testdir, monkeypatch):
+    """Run pytest with the repo's conftest.py on SAMPLE and return report.json
+    """
+    monkeypatch.setenv('PYTHONPATH', REPO_DIR)
+    with open(os.path.join(REPO_DIR, 'conftest.py')) as f:
+        testdir.makeconftest(f.read())
+    testdir.makepyfile(test_sample=SAMPLE)
+
+    def run(*args):
+        testdir.runpytest_subprocess('-p', 'no:cacheprovider', '--json=report.json', *args)
+        with open(str(testdir.tmpdir.join('report.json'))) as f:
+            return json.load(f)['report']
+    return run
+
+
+def by_name(report):
+    return {t['name'].split('::')[-1]: t for t in report['tests']}
+
+
+def test_metrics_in_report(run_report):
+    tests = by_name(run_report())
+    assert tests['test_pass']['metadata'][0]['gossip'] == {'count': 1}
+    assert tests['test_pass']['metadata'][0]['teardown']
+    assert tests['test_fail']['metadata'][0]['gossip'] == {'count': 2}
+    assert tests['test_flaky']['metadata'][0]['attempt'] == 1
+    assert sorted(tests['test_pass']['metadata'][0]['durations']) == ['call', 'setup', 'teardown']
+
+
+def test_metrics_per_attempt(run_report):
+    pytest.importorskip('pytest_rerunfailures')
+    report = run_report('--reruns=1')
+    tests = by_name(report)
+    assert tests['test_flaky']['outcome'] == 'passed'
+    assert [m['attempt'] for m in tests['test_flaky']['metadata']] == [1, 2]
+    # The teardown of the first attempt isn't logged, but still recorded
+    assert all(m['teardown'] and 'teardown' in m['durations'] for m in tests['test_flaky']['metadata'])
+    assert len(tests['test_fail']['metadata']) == 2
+    assert report['summary']['rerun'] == 2
+
+
+def test_rerun_stats(run_report, tmpdir):
+    pytest.importorskip('pytest_rerunfailures')
+    report = run_report('--reruns=2')
+    report.update(id='run', versions={})
+    db = reportdb.connect(str(tmpdir.join('reports.db')))
+    with db:
+        reportdb.add_run(db, report)
+        reportdb.add_tests(db, report['id'], report['tests'])
+
+    stats = {r['test']: r for r in reportdb.rerun_stats(db)}
+    assert (stats['test_pass']['reruns'], stats['test_pass']['wasted']) == (0, 0)
+    assert (stats['test_flaky']['reruns'], stats['test_flaky']['flaky_runs']) == (1, 1)
+    assert (stats['test_fail']['reruns'], stats['test_fail']['failed_runs']) == (2, 1)
+    assert stats['test_fail']['wasted'] > 0
+    assert sum(r['reruns'] for r in stats.values()) == report['summary']['rerun']
+    assert [r['attempts'] for r in reportdb.final_results(db)] == [3, 2, 1]
@@ -0,0 +1,118 @@
+""" Network topologies for multi-node tests
+
+A topology is a number of nodes and a list of `(opener, peer)` edges
+between node indices. `build_network` turns such a spec into a running
+network of connected nodes with confirmed channels, doing every step
+for all nodes at once rather than pair by pair.
+"""
+from utils import confirm_channels, fund_nodes, sync_blockheight, wait_for
+
+import logging
+import random
+import time
+
+
+class Topology(object):
+
+    def __init__(self, name, num_nodes, edges):
+        self.name = name
+        self.num_nodes = num_nodes
+        self.edges = edges
+
+    def __repr__(self):
+        return "Topology[{}, nodes={}, channels={}]".format(
+            self.name, self.num_nodes, len(self.edges))
+
+
+def line(num_nodes):
+    """ 0 -> 1 -> ... -> n-1
+    """
+    edges = [(i, i + 1) for i in range(num_nodes - 1)]
+    return Topology("line{}".format(num_nodes), num_nodes, edges)
+
+
+def ring(num_nodes):
+    """ A line whose last node opens a channel back to the first
+    """
+    edges = [(i, (i + 1) % num_nodes) for i in range(num_nodes)]
+    return Topology("ring{}".format(num_nodes), num_nodes, edges)
+
+
+def star(num_nodes):
+    """ Every leaf opens a channel to the hub (node 0)
+    """
+    edges = [(i, 0) for i in range(1, num_nodes)]
+    return Topology("star{}".format(num_nodes), num_nodes, edges)
+
+
+def scale_free(num_nodes, m=2, seed=None):
+    """ Barabasi-Albert preferential attachment graph
+
+    Starts from a clique of `m + 1` nodes, then every new node opens `m`
+    channels to existing nodes, picked with a probability proportional
+    to their current number of channels. Pass a `seed` to get the same
+    graph on every run.
+    """
+    if num_nodes <= m:
+        raise ValueError("Need more than {} nodes for a scale-free graph".format(m))
+    rnd = random.Random(seed)
+    edges = [(i, j) for i in range(m + 1) for j in range(i)]
+
+    # Each node appears once per channel endpoint, so uniform sampling
+    # from this list is sampling proportional to degree.
+    endpoints = [n for e in edges for n in e]
+    for new in range(m + 1, num_nodes):
+        targets = set()
+        while len(targets) < m:
+            targets.add(rnd.choice(endpoints))
+        for t in sorted(targets):
+            edges.append((new, t))
+            endpoints += [new, t]
+    return Topology("scalefree{}".format(num_nodes), num_nodes, edges)
+
+
+def build_network(node_factory, bitcoind, topology, implementation, capacity=10**7):
+    """Start, connect, fund and open all channels of `topology`.
+
+    All nodes are funded by a single transaction with one output per
+    channel to be opened, so that a node opening several channels never
+    has to wait for its own change to confirm. Channels are opened
+    concurrently and confirmed by mining the announcement depth once.
+
+    Returns the list of nodes, indexed like the topology, and the time
+    the announcement depth was mined, when gossip about the channels
+    starts.
+    """
+    executor = node_factory.executor
+    logging.info("Building network {}".format(topology))
+    nodes = node_factory.get_nodes(implementation, topology.num_nodes)
+
+    def connect(edge):
+        n1, n2 = nodes[edge[0]], nodes[edge[1]]
+        n1.connect('localhost', n2.daemon.port, n2.id())
+        wait_for(lambda: n2.id() in n1.peers(), interval=1)
+
+    list(executor.map(connect, topology.edges))
+
+    amounts = {}
+    for i, _ in topology.edges:
+        amounts.setdefault(nodes[i], []).append(2 * capacity)
+    fund_nodes(bitcoind, amounts, executor=executor)
+
+    def openchannel(edge):
+        n1, n2 = nodes[edge[0]], nodes[edge[1]]
+        n1.openchannel(n2.id(), 'localhost', n2.daemon.port, capacity)
+
+    list(executor.map(openchannel, topology.edges))
+
+    # Only mine once all funding transactions made it into the mempool
+    wait_for(lambda: len(bitcoind.rpc.getrawmempool()) >= len(topology.edges), interval=1)
+    bitcoind.rpc.generate(6)
+    announced_at = time.time()
+    sync_blockheight(bitcoind, nodes)
+
+    pairs = [(nodes[i], nodes[j]) for i, j in topology.edges]
+    times = confirm_channels(bitcoind, pairs, executor=executor)
+    if None in times:
+        raise ValueError("{} channels did not become active".format(times.count(None)))
+    return nodes, announced_at
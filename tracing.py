@@ -0,0 +1,103 @@
+""" Timelines of test runs in the Chrome trace event format
+
+With TEST_TRACE_DIR set, every test records spans for node startup, the
+node methods it calls, `wait_for` polling and the requests nodes make to
+bitcoind, and writes them to <TEST_TRACE_DIR>/<test>.json. Open those in
+chrome://tracing or https://ui.perfetto.dev, each thread gets its own
+track.
+
+Spans are only recorded while a `Tracer` is active, `span` costs a
+global lookup otherwise.
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+# The tracer of the running test, if any
+_tracer = None
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def add(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': thread.ident,
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def export(self, path):
+        """Write the spans as a Chrome trace / Perfetto JSON file.
+        """
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in self.threads.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+def start():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextlib.contextmanager
+def span(name, cat='test', **args):
+    """Record the time spent in the `with` block as a span.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        tracer.add(name, cat, start_time, time.time(), args)
+
+
+def traced(f, name, cat):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with span(name, cat):
+            return f(*args, **kwargs)
+    return wrapper
+
+
+def trace_methods(obj, names, cat):
+    """Record a span for every call of the methods `names` of `obj`.
+
+    Wraps the bound methods on the instance, so it works on any node
+    class. Methods `obj` doesn't have are skipped.
+    """
+    prefix = obj.__class__.__name__ + '.'
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is not None:
+            setattr(obj, name, traced(method, prefix + name, cat))
@@ -1,7 +1,9 @@
 from bitcoin.rpc import RawProxy as BitcoinProxy
 from ephemeral_port_reserve import reserve
 
+import asyncio
 import logging
+import psutil
 import re
 import subprocess
 import threading
@@ -11,6 +13,8 @@ import collections
 import json
 import base64
 import requests
+import tracing
+import waits
 
 
 BITCOIND_CONFIG = collections.OrderedDict([
@@ -38,6 +42,304 @@ def write_dict(f, opts):
             f.write("{}={}\n".format(k, v))
 
 
+def wait_for(success, timeout=30, interval=1):
+    with tracing.span('wait_for', 'wait', timeout=timeout, interval=interval), waits.polling(waits.caller()):
+        start_time = time.time()
+        while not success() and time.time() < start_time + timeout:
+            time.sleep(interval)
+        if time.time() > start_time + timeout:
+            raise ValueError("Error waiting for {}", success)
+
+
+def sync_blockheight(btc, nodes):
+    info = btc.rpc.getblockchaininfo()
+    blocks = info['blocks']
+
+    print("Waiting for %d nodes to blockheight %d" % (len(nodes), blocks))
+    for n in nodes:
+        wait_for(lambda: n.info()['blockheight'] == blocks, interval=1)
+
+
+def fund_nodes(bitcoind, amounts, executor=None, timeout=60):
+    """Fund many nodes with a single transaction and a single block.
+
+    `amounts` maps each node to the satoshis it should receive, either
+    as a single amount or as a list of amounts, in which case the node
+    gets one output per amount (if its wallet hands out fresh
+    addresses). Blocks until every node's wallet sees its funds,
+    checking all nodes concurrently if an `executor` is given.
+
+    Returns the txid of the funding transaction.
+    """
+    outputs = collections.OrderedDict()
+    for node, sats in amounts.items():
+        for s in (sats if isinstance(sats, list) else [sats]):
+            addr = node.getaddress()
+            outputs[addr] = outputs.get(addr, 0) + s
+
+    txid = bitcoind.rpc.sendmany("", {a: float(s) / 10**8 for a, s in outputs.items()})
+    bitcoind.rpc.generate(1)
+
+    def wait_funded(node):
+        total = sum(amounts[node]) if isinstance(amounts[node], list) else amounts[node]
+        wait_for(lambda: node.has_funds(total), interval=1, timeout=timeout)
+
+    if executor:
+        list(executor.map(wait_funded, amounts.keys()))
+    else:
+        for node in amounts.keys():
+            wait_funded(node)
+    return txid
+
+
+def confirm_channels(bitcoind, pairs, executor=None, blocks=10, interval=1):
+    """Mine until the channels between all `pairs` of nodes are active.
+
+    All pending pairs are checked in one round, concurrently if an
+    `executor` is given, and a new block is only mined if at least one
+    pair is still not active on both ends. Gives up after `blocks`
+    blocks.
+
+    Returns the seconds it took for each pair to become active, in the
+    order of `pairs`, with None for pairs that never did.
+    """
+    start_time = time.time()
+    times = [None] * len(pairs)
+    pending = list(range(len(pairs)))
+
+    def check(i):
+        n1, n2 = pairs[i]
+        return n1.check_channel(n2) and n2.check_channel(n1)
+
+    for mined in range(blocks + 1):
+        if executor:
+            results = list(executor.map(check, pending))
+        else:
+            results = [check(i) for i in pending]
+
+        elapsed = time.time() - start_time
+        for i, ok in zip(pending, results):
+            if ok:
+                n1, n2 = pairs[i]
+                logging.info("Channel {} -> {} active after {:.1f}s".format(
+                    n1.id(), n2.id(), elapsed))
+                times[i] = elapsed
+        pending = [i for i in pending if times[i] is None]
+        if not pending or mined == blocks:
+            break
+
+        bhash = bitcoind.rpc.generate(1)[0]
+        nodes = set(n for i in pending for n in pairs[i])
+        if executor:
+            list(executor.map(lambda n: n.block_sync(bhash), nodes))
+        else:
+            for n in nodes:
+                n.block_sync(bhash)
+        waits.sleep(interval)
+
+    return times
+
+
+# Per event loop, what `run_async` should await before closing it
+_loop_cleanups = {}
+
+
+def at_loop_close(cleanup):
+    """Have `run_async` await `cleanup()` before closing the running loop.
+
+    For connections of the `aio` interfaces, which are bound to the loop
+    they were opened on.
+    """
+    _loop_cleanups.setdefault(asyncio.get_event_loop(), []).append(cleanup)
+
+
+def run_async(*aws):
+    """Run `aws` concurrently on a new event loop.
+
+    Meant for the `aio` interface of the nodes, e.g.,
+    `run_async(*[node.aio.send(req) for req in invoices])`. Returns the
+    results in the order of `aws`. The thread's default loop is left
+    alone, Electrum runs its network on it from another thread.
+    """
+    # Gathered from within the loop, outside of it gather() would pick
+    # the thread's default loop
+    async def gather(aws, **kwargs):
+        return await asyncio.gather(*aws, **kwargs)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather(aws))
+    finally:
+        cleanups = _loop_cleanups.pop(loop, [])
+        if cleanups:
+            loop.run_until_complete(gather([c() for c in cleanups], return_exceptions=True))
+        loop.close()
+
+
+async def stream_rpc(reader, writer, method, params):
+    """A single JSON-RPC call over an asyncio stream.
+
+    This is the protocol of the lightningd unix socket and the ptarmd
+    TCP port: one request per connection, and the reply is complete as
+    soon as it parses as JSON. Closes the stream and returns the reply
+    object and the number of bytes it took, leaving error handling to the
+    caller.
+    """
+    decoder = json.JSONDecoder()
+    buff = b''
+    try:
+        writer.write(json.dumps({
+            'method': method,
+            'params': params,
+            'id': 0,
+        }).encode('UTF-8'))
+        await writer.drain()
+        while True:
+            b = await reader.read(65536)
+            if len(b) == 0:
+                return {'error': 'Connection to RPC server lost.'}, len(buff)
+            buff += b
+            try:
+                # Convert late to UTF-8 so glyphs split across reads do not
+                # impact us
+                obj, _ = decoder.raw_decode(buff.decode('UTF-8'))
+                return obj, len(buff)
+            except ValueError:
+                # Probably didn't read enough
+                pass
+    finally:
+        writer.close()
+
+
+class RpcTrace(object):
+    """A bounded in-memory record of RPC calls.
+
+    Arguments are only kept as the length of their compact JSON
+    encoding, and replies as the number of bytes received, as counted
+    by the caller, so that recording every call of a polling loop
+    doesn't mean encoding its large replies once more.
+    """
+
+    def __init__(self, maxlen=10000):
+        self.calls = collections.deque(maxlen=maxlen)
+
+    def record(self, method, args, start_time, result_size=0, error=None):
+        self.calls.append({
+            'method': method,
+            'start': start_time,
+            'duration': time.time() - start_time,
+            'args_size': len(json.dumps(args)),
+            'result_size': result_size,
+            'error': str(error) if error is not None else None,
+        })
+
+    def summary(self):
+        """Number of calls, time spent and bytes returned per method.
+        """
+        methods = {}
+        for c in self.calls:
+            m = methods.setdefault(c['method'], {
+                'calls': 0, 'errors': 0, 'duration': 0, 'result_size': 0})
+            m['calls'] += 1
+            m['errors'] += c['error'] is not None
+            m['duration'] += c['duration']
+            m['result_size'] += c['result_size']
+        return methods
+
+
+class CountingSocket(object):
+    """Wraps a socket, counting the bytes received through it.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+
+    def recv(self, *args):
+        b = self.sock.recv(*args)
+        self.received += len(b)
+        return b
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class ResourceSampler(object):
+    """Samples CPU, memory, open files and threads of a process tree.
+
+    The process and all its descendants are added up, eclair for example
+    runs in a child JVM. Sampling stops with `stop` or when the process
+    exits. CPU use is measured between samples, so the first sample of
+    each process reports 0%. Times are counted from the first `start`, a
+    restarted daemon continues the same series after a gap.
+    """
+
+    def __init__(self, interval=1.0, maxlen=3600):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=maxlen)
+        self.stopped = threading.Event()
+        self.start_time = None
+
+    def start(self, pid):
+        if self.start_time is None:
+            self.start_time = time.time()
+        # A new event per start, the sampling of a previous start may not
+        # have seen its `stop` yet
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self.run, args=(pid, self.stopped))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, pid, stopped):
+        procs = {}
+        try:
+            root = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+        while not stopped.is_set():
+            try:
+                if root.status() == psutil.STATUS_ZOMBIE:
+                    break
+                tree = [root] + root.children(recursive=True)
+            except psutil.NoSuchProcess:
+                break
+            # Keep the Process objects, cpu_percent measures since the last call
+            procs = {p.pid: procs.get(p.pid, p) for p in tree}
+            sample = {'time': time.time() - self.start_time, 'cpu': 0.0, 'rss': 0, 'fds': 0, 'threads': 0, 'procs': 0}
+            for p in procs.values():
+                try:
+                    with p.oneshot():
+                        sample['cpu'] += p.cpu_percent()
+                        sample['rss'] += p.memory_info().rss
+                        sample['fds'] += p.num_fds()
+                        sample['threads'] += p.num_threads()
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+                sample['procs'] += 1
+            self.samples.append(sample)
+            stopped.wait(self.interval)
+
+    def summary(self):
+        """The samples as one list per measurement, plus peak and total use.
+        """
+        samples = list(self.samples)
+        series = {k: [s[k] for s in samples] for k in ['time', 'cpu', 'rss', 'fds', 'threads', 'procs']}
+        series['time'] = [round(t, 2) for t in series['time']]
+        series['cpu'] = [round(c, 1) for c in series['cpu']]
+        series.update({
+            'interval': self.interval,
+            'start': self.start_time,
+            'cpu_seconds': sum(series['cpu']) / 100 * self.interval,
+            'max_rss': max(series['rss'], default=0),
+            'max_fds': max(series['fds'], default=0),
+            'max_threads': max(series['threads'], default=0),
+        })
+        return series
+
+
 class TailableProc(object):
     """A monitorable process that we can start, stop and tail.
 
@@ -53,6 +355,12 @@ class TailableProc(object):
         self.proc = None
         self.outputDir = outputDir
         self.logger = logging.getLogger(prefix)
+        self.sampler = None
+
+    def enable_sampling(self, interval=1.0):
+        """Sample the resource use of the process once it is started.
+        """
+        self.sampler = ResourceSampler(interval)
 
     def start(self):
         """Start the underlying process and start monitoring it.
@@ -63,6 +371,8 @@ class TailableProc(object):
         self.proc = subprocess.Popen(self.cmd_line, stdout=subprocess.PIPE)
         self.thread.start()
         self.running = True
+        if self.sampler:
+            self.sampler.start(self.proc.pid)
 
     def save_log(self):
         if self.outputDir:
@@ -72,6 +382,8 @@ class TailableProc(object):
                     f.write(l + '\n')
 
     def stop(self):
+        if self.sampler:
+            self.sampler.stop()
         self.proc.terminate()
         self.proc.kill()
         self.save_log()
@@ -115,6 +427,10 @@ class TailableProc(object):
         effects.
 
         """
+        with tracing.span('wait_for_log', 'wait', regex=regex), waits.polling(waits.caller()):
+            return self._wait_for_log(regex, offset, timeout)
+
+    def _wait_for_log(self, regex, offset, timeout):
         logging.debug("Waiting for '%s' in the logs", regex)
         ex = re.compile(regex)
         start_time = time.time()
@@ -144,6 +460,30 @@ class TailableProc(object):
                     return self.logs[pos]
                 pos += 1
 
+    async def wait_for_log_async(self, regex, offset=1000, timeout=60, match=None):
+        """`wait_for_log` for coroutines.
+
+        Polls the logs instead of blocking on `logs_cond`, so that many
+        coroutines can wait on a single thread. Lines matching `regex`
+        are skipped unless `match`, if given, returns True for them.
+        """
+        ex = re.compile(regex)
+        start_time = time.time()
+        pos = max(len(self.logs) - offset, 0)
+        while True:
+            while pos < len(self.logs):
+                if ex.search(self.logs[pos]) and (match is None or match(self.logs[pos])):
+                    logging.debug("Found '%s' in logs", regex)
+                    return self.logs[pos]
+                pos += 1
+
+            if time.time() > start_time + timeout:
+                raise TimeoutError(
+                    'Unable to find "{}" in logs.'.format(regex))
+            elif not self.running:
+                raise ValueError('Process died while waiting for logs')
+            await asyncio.sleep(0.1)
+
 
 class BitcoinRpc(object):
     def __init__(self, url=None, rpcport=8332, rpcuser=None, rpcpassword=None):
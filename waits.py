@@ -0,0 +1,125 @@
+""" Accounting of the time tests spend waiting
+
+Time spent in a test is split into three kinds:
+
+ - sleep: fixed sleeps through `sleep`, giving a daemon time to catch up,
+ - poll: waiting for a condition, in `wait_for`, `wait_for_log` and loops
+   wrapped in `polling`, including the checks themselves,
+ - work: everything else.
+
+Sleeps inside a poll count as polling. Only the thread running the test
+adds up to its duration, waits on executor threads are reported
+separately as background waits. Every sleep and poll is also attributed
+to the line of code it was called from, see `WaitStats.summary`.
+"""
+import contextlib
+import sys
+import threading
+import time
+import tracing
+
+
+# The stats of the running test, if any
+_stats = None
+_local = threading.local()
+
+
+class WaitStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.main = threading.current_thread().ident
+        self.start_time = time.time()
+        self.totals = {'sleep': 0.0, 'poll': 0.0, 'background_sleep': 0.0, 'background_poll': 0.0}
+        self.sites = {}
+
+    def add(self, kind, site, seconds):
+        key = kind if threading.current_thread().ident == self.main else 'background_' + kind
+        with self.lock:
+            self.totals[key] += seconds
+            s = self.sites.setdefault(site, {'kind': kind, 'count': 0, 'seconds': 0.0})
+            s['count'] += 1
+            s['seconds'] += seconds
+
+    def summary(self, top=10):
+        """Seconds per kind of wait, and the `top` lines of code waited at.
+        """
+        duration = time.time() - self.start_time
+        with self.lock:
+            summary = dict(self.totals)
+            sites = sorted(self.sites.items(), key=lambda kv: -kv[1]['seconds'])[:top]
+        summary['duration'] = duration
+        summary['work'] = max(duration - summary['sleep'] - summary['poll'], 0.0)
+        summary['sites'] = dict(sites)
+        return summary
+
+
+def start():
+    global _stats
+    _stats = WaitStats()
+    return _stats
+
+
+def stop():
+    global _stats
+    stats, _stats = _stats, None
+    return stats
+
+
+def caller(level=1):
+    """'file.py:line' of the caller `level` frames above the calling function.
+    """
+    frame = sys._getframe(level + 1)
+    return "{}:{}".format(frame.f_code.co_filename.split('/')[-1], frame.f_lineno)
+
+
+def sleep(seconds):
+    """`time.sleep` that counts as a fixed sleep, or polling inside `polling`.
+    """
+    stats = _stats
+    if stats is None or getattr(_local, 'polling', 0):
+        time.sleep(seconds)
+        return
+    site = caller()
+    start_time = time.time()
+    with tracing.span('sleep', 'wait', seconds=seconds, site=site):
+        time.sleep(seconds)
+    stats.add('sleep', site, time.time() - start_time)
+
+
+@contextlib.contextmanager
+def polling(site=None):
+    """Count the `with` block as polling, attributed to `site`.
+
+    Nested polls only count once, for the outermost one.
+    """
+    stats = _stats
+    depth = getattr(_local, 'polling', 0)
+    if stats is None or depth:
+        yield
+        return
+    site = site or caller(2)
+    _local.polling = 1
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        _local.polling = 0
+        stats.add('poll', site, time.time() - start_time)
+
+
+def merge(summaries, top=20):
+    """Add up the summaries of many tests, keeping the `top` sites.
+    """
+    totals = {}
+    sites = {}
+    for summary in summaries:
+        for k, v in summary.items():
+            if k != 'sites':
+                totals[k] = totals.get(k, 0.0) + v
+        for site, s in summary.get('sites', {}).items():
+            m = sites.setdefault(site, {'kind': s['kind'], 'count': 0, 'seconds': 0.0})
+            m['count'] += s['count']
+            m['seconds'] += s['seconds']
+    totals['sites'] = dict(sorted(sites.items(), key=lambda kv: -kv[1]['seconds'])[:top])
+    return totals